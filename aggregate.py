@@ -0,0 +1,166 @@
+"""
+Daily, monthly and winter-season summaries of energy and met frames.
+
+METAR records are irregular, so every observation is weighted by the time
+until the next one (capped at MAX_GAP, so outages don't stretch the last
+value over days). One grouped pass turns a frame into per-day sums of
+weight x value and of weight. Everything else is built from those daily
+sums:
+
+* time-weighted means in the frame's units (W/m^2 for fluxes)
+* totals in MJ/m^2 for the flux columns
+* monthly and winter-season summaries
+* rolling N-day net flux
+
+Buckets follow the wall clock of the frame's index, so a frame from
+make_metar_dataframe_local is summarized in station local days.
+
+A day is closed once the record has observations after it, and a closed
+day's sums never change. cached_daily_sums keeps the closed days in a file,
+so extending a record only sums the days that are new.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+import timing
+from flux_io import read_frame, write_frame
+from utils import ENERGY_COLUMNS, index_ns
+
+# longest interval a single observation is allowed to stand for
+MAX_GAP = pd.Timedelta('3h')
+# the ice season, October to April, labelled by the year it starts in
+WINTER_START_MONTH = 10
+WINTER_END_MONTH = 4
+# columns in W/m^2 that also get totals in MJ/m^2
+FLUX_COLUMNS = ENERGY_COLUMNS
+
+
+def observation_weights(index, max_gap=MAX_GAP):
+    """Seconds each observation stands for: the time to the next one, capped at max_gap"""
+    t = index_ns(index)
+    if len(t) == 0:
+        return np.empty(0)
+    dt = np.empty(len(t))
+    dt[:-1] = np.diff(t) / 1e9
+    # the last observation gets the typical spacing
+    dt[-1] = np.median(dt[:-1]) if len(t) > 1 else 0.0
+    return np.clip(dt, 0, max_gap.total_seconds())
+
+
+def local_days(index):
+    # naive midnight of each observation in the index's own wall clock
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.normalize()
+
+
+@timing.timed('daily_sums', count='input')
+def daily_sums(frame, max_gap=MAX_GAP):
+    """
+    Per-day sums of a met or energy frame, indexed by date: for every numeric
+    column its weighted sum (value x seconds) and its weight ('<col> seconds'),
+    plus 'seconds' covered and 'observations'.
+    """
+    frame = frame.select_dtypes('number').sort_index()
+    columns = list(frame.columns)
+    values = frame.to_numpy(dtype=np.float64)
+    w = observation_weights(frame.index, max_gap)
+
+    # NaNs carry no weight, so each column is averaged over its own valid data
+    weights = np.where(np.isnan(values), 0.0, w[:, None])
+    block = np.hstack([np.nan_to_num(values) * weights, weights, w[:, None], np.ones((len(w), 1))])
+    names = columns + ['%s seconds' % c for c in columns] + ['seconds', 'observations']
+    sums = pd.DataFrame(block, columns=names).groupby(local_days(frame.index).to_numpy()).sum()
+    sums.index = pd.DatetimeIndex(sums.index, name='date')
+    return sums
+
+
+def cached_daily_sums(frame, path, max_gap=MAX_GAP):
+    """
+    daily_sums with the closed days kept in path (Parquet or Feather).
+    Days already in the file are not summed again, only the newer part of
+    frame is. The cache belongs to one station and one set of flux
+    parameters, use a new path when either changes.
+    """
+    cached = read_frame(path) if os.path.exists(path) else None
+    if cached is not None and len(cached):
+        new = frame[local_days(frame.index) > cached.index[-1]]
+        sums = pd.concat([cached, daily_sums(new, max_gap)]) if len(new) else cached
+    else:
+        sums = daily_sums(frame, max_gap)
+
+    # the last day of the record may still gain observations
+    last_day = local_days(frame.index).max() if len(frame) else None
+    closed = sums[sums.index < last_day] if last_day is not None else sums
+    if cached is None or len(closed) > len(cached):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        write_frame(closed, path)
+    return sums
+
+
+def winter_season(dates):
+    # start year of the winter each date falls in, -1 outside the season
+    year = np.where(dates.month >= WINTER_START_MONTH, dates.year, dates.year - 1)
+    in_season = (dates.month >= WINTER_START_MONTH) | (dates.month <= WINTER_END_MONTH)
+    return np.where(in_season, year, -1)
+
+
+def finish(sums):
+    # turn summed buckets into means, totals and coverage
+    columns = [c for c in sums.columns if '%s seconds' % c in sums.columns]
+    out = {}
+    for c in columns:
+        seconds = sums['%s seconds' % c].to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['%s mean' % c if c not in FLUX_COLUMNS else '%s mean (W/m^2)' % c] = sums[c] / seconds
+        if c in FLUX_COLUMNS:
+            out['%s total (MJ/m^2)' % c] = sums[c] / 1e6
+    out['hours'] = sums['seconds'] / 3600.0
+    out['observations'] = sums['observations'].astype(np.int64)
+    return pd.DataFrame(out, index=sums.index)
+
+
+def summarize(frame=None, freq='month', sums=None, max_gap=MAX_GAP):
+    """
+    Summary of an energy or met frame per 'day', 'month', 'year' or 'winter'
+    (October to April, labelled by its start year). Flux columns get a
+    time-weighted mean in W/m^2 and a total in MJ/m^2, other columns a mean;
+    'hours' and 'observations' give the coverage of each bucket.
+    Pass sums from daily_sums or cached_daily_sums to skip summing the frame.
+    """
+    if sums is None:
+        sums = daily_sums(frame, max_gap)
+    dates = sums.index
+    if freq == 'day':
+        grouped = sums
+    elif freq == 'month':
+        grouped = sums.groupby(dates.to_period('M').rename('month')).sum()
+    elif freq == 'year':
+        grouped = sums.groupby(dates.to_period('Y').rename('year')).sum()
+    elif freq == 'winter':
+        season = winter_season(dates)
+        keep = season >= 0
+        grouped = sums[keep].groupby(pd.Index(season[keep], name='winter')).sum()
+        grouped.index = ['%d-%d' % (y, y + 1) for y in grouped.index]
+        grouped.index.name = 'winter'
+    else:
+        raise ValueError("freq must be 'day', 'month', 'year' or 'winter', not %r" % (freq,))
+    return finish(grouped)
+
+
+def rolling_net_flux(frame=None, days=7, column='net flux', sums=None, max_gap=MAX_GAP):
+    """
+    Net flux over the N days ending on each date: time-weighted mean (W/m^2)
+    and total (MJ/m^2). Days without data count as empty, not skipped.
+    """
+    if sums is None:
+        sums = daily_sums(frame[[column]], max_gap)
+    full = pd.date_range(sums.index.min(), sums.index.max(), freq='D', name='date')
+    sums = sums[[column, '%s seconds' % column]].reindex(full, fill_value=0.0)
+    window = sums.rolling(days, min_periods=1).sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = window[column] / window['%s seconds' % column]
+    return pd.DataFrame({'%s %d-day mean (W/m^2)' % (column, days): mean,
+                         '%s %d-day total (MJ/m^2)' % (column, days): window[column] / 1e6})
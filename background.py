@@ -0,0 +1,158 @@
+"""
+Background jobs for the Streamlit apps.
+
+A Job runs a pipeline function in a thread pool shared by every session of
+the server, so a long download or calculation neither freezes the page nor
+restarts when a widget changes: the session keeps its Job in
+st.session_state and each script run just shows where it has got to.
+
+The pipeline function receives the job and reports through it:
+
+    def pipeline(job, station):
+        job.begin('download')
+        df = ...
+        job.finish('download', met_df=df)   # partial results can be shown right away
+        job.check()                         # raises Cancelled once job.cancel() was called
+
+Finished jobs are kept by key for a while, so asking for the same thing
+again (from any session) returns the results without running anything.
+Keys of windows reaching up to now include refresh_bucket(), so those are
+fetched again after a while.
+
+The stage functions the pipelines call are st.cache_data'd on small keys
+(station, dates, settings) rather than on the data they receive, so nothing
+large is hashed; the data and the job are passed in underscore arguments,
+which streamlit does not hash.
+"""
+import collections
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import timing
+
+# pipelines running at once across all sessions, the IEM downloads inside
+# them are also limited per host by iowa_metar_scrape
+MAX_WORKERS = 4
+# finished jobs kept for reuse
+MAX_FINISHED = 32
+# Windows that end within this many days of now can still gain observations
+RECENT_DAYS = 2
+# and are cached for at most this long
+REFRESH_MINUTES = 15
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='heatflux-job')
+_finished = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def refresh_bucket(endts):
+    """
+    Part of the keys of a window ending at endts (YYYYMMDD): constant for
+    windows that are long over, changing every REFRESH_MINUTES for windows
+    reaching up to now
+    """
+    end = datetime.datetime.strptime(endts, '%Y%m%d')
+    if datetime.datetime.utcnow() - end > datetime.timedelta(days=RECENT_DAYS):
+        return 0
+    return int(time.time() // (REFRESH_MINUTES * 60))
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, key, stages):
+        self.key = key
+        self.stages = list(stages)
+        self.done_stages = []
+        self.stage = None
+        self.results = {}
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.timings = timing.Recorder()
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    # called from the pipeline
+    def begin(self, stage):
+        self.check()
+        self.stage = stage
+
+    def finish(self, stage, **results):
+        with self._lock:
+            self.results.update(results)
+            self.done_stages.append(stage)
+            self.stage = None
+
+    def check(self):
+        if self._cancel.is_set():
+            raise Cancelled()
+
+    # called from the app
+    def cancel(self):
+        # a finished job may be shown to other sessions, leave it alone
+        if not self.done:
+            self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    def progress(self):
+        """Fraction of the stages done, and a line describing the current one"""
+        fraction = len(self.done_stages) / float(len(self.stages) or 1)
+        if self.error is not None:
+            text = 'Failed: %s' % self.error
+        elif self.done:
+            text = 'Cancelled' if self.cancelled else 'Done in %.1f s' % (self.finished - self.started)
+        elif self.stage:
+            text = '%s (%d of %d), %.0f s' % (self.stage, len(self.done_stages) + 1, len(self.stages),
+                                             time.time() - self.started)
+        else:
+            text = 'Waiting for a worker'
+        return fraction, text
+
+    def snapshot(self):
+        # the results so far, safe to use while the job is still adding to them
+        with self._lock:
+            return dict(self.results)
+
+
+def _run(job, func, args, kwargs):
+    try:
+        with timing.recording(job.timings):
+            func(job, *args, **kwargs)
+    except Cancelled:
+        pass
+    except Exception as exp:
+        job.error = '%s: %s' % (type(exp).__name__, exp)
+    finally:
+        job.finished = time.time()
+    if job.error is None and not job.cancelled:
+        with _lock:
+            _finished[job.key] = job
+            _finished.move_to_end(job.key)
+            while len(_finished) > MAX_FINISHED:
+                _finished.popitem(last=False)
+
+
+def submit(key, stages, func, *args, **kwargs):
+    """
+    Start func(job, *args, **kwargs) in the background and return its Job,
+    or the finished Job of an earlier run with the same key.
+    """
+    with _lock:
+        if key in _finished:
+            _finished.move_to_end(key)
+            return _finished[key]
+    job = Job(key, stages)
+    _executor.submit(_run, job, func, args, kwargs)
+    return job
@@ -0,0 +1,232 @@
+"""
+Headless batch pipeline: download -> decode -> fluxes -> export for many stations.
+
+Stations are downloaded month by month by threads of this process, so all
+requests share one IEM rate limiter, into OUTDIR/raw (not the app's day
+cache). Decoding and fluxes then run in worker processes, and each station
+is written to OUTDIR as soon as it finishes. Progress is kept in OUTDIR/batch_status.json, so rerunning
+the same command after a crash or a failed night only processes the
+stations that are not done yet. Output names carry a hash of the flux
+settings, so a rerun with e.g. another --water-temp processes every station
+again instead of keeping the old results.
+
+    python batch_run.py OGA LBF --start 20230101 --end 20230401 --outdir out
+    python batch_run.py --station-file mystations.txt --start 20220101 --end 20230101 --workers 8
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import iowa_metar_scrape as ia
+import metar_cache
+import timing
+from flux_io import write_frame
+from qc import clean_met
+from utils import (
+    iter_metar_files,
+    make_metar_dataframe,
+    make_metar_dataframe_local,
+    calc_energy_df,
+    return_lat_lon,
+)
+
+STATUS_FILE = 'batch_status.json'
+
+
+def run_key(T_water_C, a, b, c, R, local_time, float32=False, grid=None):
+    # short hash of the settings that change the results, part of the output
+    # names so a rerun with other settings doesn't take old files as done
+    params = {'T_water_C': float(T_water_C), 'a': float(a), 'b': float(b), 'c': float(c), 'R': float(R),
+              'local_time': bool(local_time), 'float32': bool(float32), 'grid': grid}
+    return hashlib.md5(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+
+def output_paths(outdir, station, startts, endts, fmt='csv', key=''):
+    stem = os.path.join(outdir, '_'.join(part for part in (station, startts, endts, key) if part))
+    return {'met': '%s_met.%s' % (stem, fmt), 'energy': '%s_energy_flux.%s' % (stem, fmt),
+            'timings': '%s_timings.json' % stem}
+
+
+def download_station(station, startts, endts, rawdir):
+    """
+    Download one station a month per file into rawdir, months already there
+    are kept. Runs in the parent process so every request goes through its
+    rate limiter and host semaphore.
+    Returns (file names, download timing records), raises IOError if any
+    month failed.
+    """
+    os.makedirs(rawdir, exist_ok=True)
+    files, failed = [], []
+    with timing.recording() as rec:
+        for start, end in ia.month_ranges(datetime.datetime.strptime(startts, '%Y%m%d'),
+                                          datetime.datetime.strptime(endts, '%Y%m%d')):
+            outfn = os.path.join(rawdir, '%s_%s_%s.txt' % (station, start.strftime('%Y%m%d'),
+                                                           end.strftime('%Y%m%d')))
+            if not os.path.exists(outfn):
+                written = ia.download_to_file(ia.build_uri(station, start, end), outfn)
+                if written is None:
+                    failed.append((start, end))
+                if not written:
+                    # failed, or no observations that month
+                    continue
+            files.append(outfn)
+    if failed:
+        raise IOError(metar_cache.failed_message(station, failed))
+    return files, rec.records
+
+
+def process_station(station, startts, endts, outdir, T_water_C, a, b, c, R, local_time, fmt='csv',
+                    float32=False, timings=False, grid=None, files=(), download_records=()):
+    """
+    Decode the downloaded files of one station and compute its fluxes, returns
+    the number of flux rows
+    """
+    key = run_key(T_water_C, a, b, c, R, local_time, float32, grid)
+    paths = output_paths(outdir, station, startts, endts, fmt, key)
+    with timing.recording() as rec:
+        # the downloads were timed in the parent process
+        rec.records.extend(download_records)
+        chunks = iter_metar_files(files)
+        df = make_metar_dataframe_local(chunks) if local_time else make_metar_dataframe(chunks)
+        if df.empty:
+            raise ValueError('no observations for %s between %s and %s' % (station, startts, endts))
+        if grid:
+            # deduplicated, range checked and interpolated onto a regular grid
+            df = clean_met(df, grid)
+
+        lat, lon = return_lat_lon(df)
+        # one float32 block instead of six Series and their copies, long records fit in memory
+        energy_df = calc_energy_df(df, T_water_C, lat, lon, a, b, c, R)
+
+        # write_frame goes through a temp file, a half written file never looks finished
+        with timing.stage('write', rows=len(energy_df)):
+            write_frame(df, paths['met'], float32=float32)
+            write_frame(energy_df, paths['energy'], float32=float32)
+
+    if timings:
+        with open(paths['timings'], 'w') as f:
+            f.write(rec.to_json(indent=1))
+    return len(energy_df)
+
+
+def load_status(outdir):
+    try:
+        with open(os.path.join(outdir, STATUS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_status(outdir, status):
+    path = os.path.join(outdir, STATUS_FILE)
+    with open(path + '.part', 'w') as f:
+        json.dump(status, f, indent=1, sort_keys=True)
+    os.replace(path + '.part', path)
+
+
+def run_batch(stations, startts, endts, outdir, T_water_C=2.0, a=10 ** -6, b=10 ** -6, c=1, R=1,
+              local_time=False, workers=4, retry_failed=True, fmt='csv', float32=False, timings=False, grid=None,
+              downloads=None):
+    """
+    Download stations in downloads threads (ia.MAX_WORKERS by default) and
+    process them in a pool of workers processes, skipping those already done
+    in outdir with the same period and settings.
+    Returns the status dict {station: {'state': 'done' | 'failed', 'run': key, ...}}.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    status = load_status(outdir)
+    # the status only counts for the run it was recorded for
+    key = run_key(T_water_C, a, b, c, R, local_time, float32, grid)
+    run = '%s_%s_%s' % (startts, endts, key)
+    todo = []
+    for station in stations:
+        entry = status.get(station, {})
+        if entry.get('run') != run:
+            entry = {}
+        paths = output_paths(outdir, station, startts, endts, fmt, key)
+        done = entry.get('state') == 'done' and all(os.path.exists(paths[k]) for k in ('met', 'energy'))
+        if done or (entry.get('state') == 'failed' and not retry_failed):
+            continue
+        todo.append(station)
+    print('%d of %d stations to process' % (len(todo), len(stations)))
+
+    rawdir = os.path.join(outdir, 'raw')
+    n = 0
+    with ThreadPoolExecutor(max_workers=downloads or ia.MAX_WORKERS) as fetchers, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        # future -> (station, downloaded files), files is None while downloading
+        jobs = {fetchers.submit(download_station, station, startts, endts, rawdir): (station, None)
+                for station in todo}
+        while jobs:
+            finished, _ = wait(jobs, return_when=FIRST_COMPLETED)
+            for future in finished:
+                station, files = jobs.pop(future)
+                try:
+                    result = future.result()
+                except Exception as exp:
+                    n += 1
+                    status[station] = {'state': 'failed', 'run': run, 'error': '%s: %s' % (type(exp).__name__, exp)}
+                    print('[%d/%d] %s failed: %s' % (n, len(todo), station, exp))
+                    traceback.print_exc()
+                    save_status(outdir, status)
+                    continue
+                if files is None:
+                    files, records = result
+                    jobs[pool.submit(process_station, station, startts, endts, outdir, T_water_C, a, b, c, R,
+                                     local_time, fmt, float32, timings, grid, files, records)] = (station, files)
+                    continue
+                n += 1
+                status[station] = {'state': 'done', 'run': run, 'rows': result}
+                print('[%d/%d] %s: %d rows' % (n, len(todo), station, result))
+                save_status(outdir, status)
+                # the raw months are only kept to resume a failed station
+                for fn in files:
+                    os.remove(fn)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch heat flux calculation for ASOS stations')
+    parser.add_argument('stations', nargs='*', help='airport codes, e.g. OGA')
+    parser.add_argument('--station-file', help='file with one station per line')
+    parser.add_argument('--start', required=True, help='start date YYYYMMDD (UTC)')
+    parser.add_argument('--end', required=True, help='end date YYYYMMDD (UTC, exclusive)')
+    parser.add_argument('--outdir', default='heatflux_output')
+    parser.add_argument('--water-temp', type=float, default=2.0, help='water temperature (C)')
+    parser.add_argument('--a', type=float, default=10 ** -6)
+    parser.add_argument('--b', type=float, default=10 ** -6)
+    parser.add_argument('--c', type=float, default=1.0)
+    parser.add_argument('--R', type=float, default=1.0)
+    parser.add_argument('--local-time', action='store_true', help='index output in station local time')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet', 'feather'])
+    parser.add_argument('--float32', action='store_true', help='store met and flux values as float32')
+    parser.add_argument('--grid', help='QC and regularize the met data onto this grid before the fluxes, e.g. 1h')
+    parser.add_argument('--timings', action='store_true', help='write per stage timings of each station as json')
+    # processes for decoding and fluxes, the downloads run in this process
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--skip-failed', action='store_true', help="don't retry stations that failed before")
+    args = parser.parse_args(argv)
+
+    stations = list(args.stations)
+    if args.station_file:
+        stations += ia.get_stations_from_filelist(args.station_file)
+    stations = [s for s in dict.fromkeys(stations) if s]
+    if not stations:
+        parser.error('no stations given')
+
+    status = run_batch(stations, args.start, args.end, args.outdir, args.water_temp, args.a, args.b, args.c,
+                       args.R, local_time=args.local_time, workers=args.workers,
+                       retry_failed=not args.skip_failed, fmt=args.format, float32=args.float32,
+                       timings=args.timings, grid=args.grid)
+    failed = [s for s in stations if status.get(s, {}).get('state') != 'done']
+    print('%d done, %d failed' % (len(stations) - len(failed), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Benchmark of the heat_budget kernels against a naive Python loop.
+
+Runs hourly synthetic forcing for a number of years and stations through the
+numba kernel (if installed), the kernel used without numba and a plain per-station,
+per-step Python loop, checks they agree and prints the timings.
+
+    python benchmarks/bench_heat_budget.py --years 20 --stations 50
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import heat_budget  # noqa: E402
+
+
+def synthetic_forcing(n_steps, n_stations, seed=0):
+    rng = np.random.default_rng(seed)
+    hours = np.arange(n_steps)[:, None]
+    season = np.cos(2 * np.pi * hours / 8766.0)
+    day = np.maximum(np.sin(2 * np.pi * (hours % 24) / 24.0), 0)
+    T_air = 5 - 15 * season + rng.normal(0, 3, (n_steps, n_stations))
+    Cl = rng.uniform(0, 1, (n_steps, n_stations))
+    q_sw = 600 * day * (1 - 0.6 * season) * (1 - 0.65 * Cl ** 2) * 0.85
+    q_atm = heat_budget.calc_downwelling_LW(T_air, Cl)
+    ea = heat_budget.calc_vapor_pressure(T_air - rng.uniform(1, 8, (n_steps, n_stations)))
+    P = rng.normal(1013, 8, (n_steps, n_stations))
+    f_U = heat_budget.calc_wind_function(1e-6, 1e-6, 1, 1, rng.gamma(2, 2, (n_steps, n_stations)))
+    dt = np.full(n_steps, 3600.0)
+    return dt, q_sw, q_atm, T_air, ea, P, f_U
+
+
+def naive_loop(dt, q_sw, q_atm, T_air, ea, P, f_U, T0, depth):
+    n, m = q_sw.shape
+    heat_capacity = heat_budget.RHO_WATER * heat_budget.CP_WATER * depth
+    sbc = 5.670374419 * 10 ** -8
+    out = [[0.0] * m for _ in range(n)]
+    for j in range(m):
+        Tw = T0
+        for i in range(n):
+            out[i][j] = Tw
+            Twk = Tw + 273.15
+            q_b = 0.97 * sbc * Twk ** 4
+            Lv = 2.500 * 10 ** 6 - 2.386 * 10 ** 3 * Tw
+            es = 6984.505294 + Twk * (-188.903931 + Twk * (2.133357675 + Twk * (-1.28858097 * 10 ** -2 + Twk * (
+                    4.393587233 * 10 ** -5 + Twk * (-8.023923082 * 10 ** -8 + Twk * 6.136820929 * 10 ** -11)))))
+            q_l = 0.622 / P[i, j] * Lv * 1000 * (es - ea[i, j]) * f_U[i, j]
+            q_h = 1.006 * 10 ** 3 * 1000 * (T_air[i, j] - Tw) * f_U[i, j]
+            q_net = q_sw[i, j] + q_atm[i, j] - q_b + q_h - q_l
+            if not math.isnan(q_net):
+                Tw = max(Tw + q_net * dt[i] / heat_capacity, heat_budget.T_FREEZE)
+    return np.array(out)
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    print('%-8s %8.3f s' % (label, time.perf_counter() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--years', type=float, default=20)
+    parser.add_argument('--stations', type=int, default=20)
+    parser.add_argument('--naive-stations', type=int, default=2,
+                        help='stations run through the naive loop, it is slow')
+    args = parser.parse_args()
+
+    n_steps = int(args.years * 8766)
+    forcing = synthetic_forcing(n_steps, args.stations)
+    print('%d hourly steps x %d stations' % (n_steps, args.stations))
+
+    results = {}
+    if heat_budget.step_numba is not None:
+        # first call compiles
+        heat_budget.run_heat_budget(*(v[:10] for v in forcing), 4.0, 2.0, use_numba=True)
+        results['numba'] = timed('numba', heat_budget.run_heat_budget, *forcing, 4.0, 2.0, use_numba=True)
+    results['fallback'] = timed('fallback', heat_budget.run_heat_budget, *forcing, 4.0, 2.0, use_numba=False)
+
+    k = min(args.naive_stations, args.stations)
+    naive = timed('naive', naive_loop, forcing[0], *(v[:, :k] for v in forcing[1:]), 4.0, 2.0)
+    print('naive loop for all stations would take about %.1fx as long' % (args.stations / float(k)))
+    for label, result in results.items():
+        print('%-8s max abs difference from naive: %.2e C' % (label, np.abs(result[:, :k] - naive).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Benchmark of the decode, flux and plotting paths on synthetic METAR data.
+
+Generates IEM-format CSVs (20 minute routine reports plus some SPECI
+reports, missing values and sky codes like the real service) for any number
+of stations and days, and times make_metar_dataframe,
+make_metar_dataframe_local, calc_fluxes, build_energy_df, calc_energy_df,
+plot_met and plot_historic_heat_fluxes on each of them. Elevation and
+clear-sky solar are stubbed so no network or pvlib time is included.
+
+Results can be saved as json and compared against an earlier run, the exit
+status is 1 if any function got slower than the tolerance allows.
+
+    python benchmarks/bench_pipeline.py --days 365 --stations 5 --output before.json
+    python benchmarks/bench_pipeline.py --days 365 --stations 5 --baseline before.json
+    python benchmarks/bench_pipeline.py --days 7305 --stations 500 --repeat 1
+"""
+import argparse
+import atexit
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# timezone, elevation and clear-sky tables go to a scratch directory so every
+# run starts from the same (empty) cache
+if 'HEATFLUX_CACHE_DIR' not in os.environ:
+    os.environ['HEATFLUX_CACHE_DIR'] = tempfile.mkdtemp(prefix='heatflux_bench_')
+    atexit.register(shutil.rmtree, os.environ['HEATFLUX_CACHE_DIR'], ignore_errors=True)
+
+import elevation  # noqa: E402
+import utils  # noqa: E402
+
+IEM_COLUMNS = ['station', 'valid', 'lon', 'lat', 'tmpf', 'dwpf', 'relh', 'drct', 'sknt', 'p01i', 'alti', 'mslp',
+               'vsby', 'gust', 'skyc1', 'skyc2', 'skyc3', 'skyc4', 'skyl1', 'skyl2', 'skyl3', 'skyl4', 'wxcodes',
+               'ice_accretion_1hr', 'ice_accretion_3hr', 'ice_accretion_6hr', 'peak_wind_gust', 'peak_wind_drct',
+               'peak_wind_time', 'feel', 'metar', 'snowdepth']
+SKY_CODES = np.array(['CLR', 'FEW', 'SCT', 'BKN', 'OVC', 'VV ', 'M'])
+FUNCTIONS = ['make_metar_dataframe', 'make_metar_dataframe_local', 'calc_fluxes', 'build_energy_df',
+             'calc_energy_df', 'plot_met', 'plot_historic_heat_fluxes']
+
+
+def synthetic_metar_csv(station, lat, lon, start, days, seed=0, speci_fraction=0.05, missing_fraction=0.02):
+    """IEM asos.py style csv text for one station, preamble included"""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    routine = pd.date_range(start, start + pd.Timedelta(days=days), freq='20min', inclusive='left')
+    speci = start + pd.to_timedelta(rng.uniform(0, days * 86400, int(len(routine) * speci_fraction)), unit='s')
+    valid = routine.append(pd.DatetimeIndex(speci).floor('min')).sort_values()
+    n = len(valid)
+
+    hours = (valid - start).total_seconds().to_numpy() / 3600.0
+    season = np.cos(2 * np.pi * (hours / 8766.0))
+    day = np.sin(2 * np.pi * ((hours + lon / 15.0) % 24) / 24.0)
+    tmpf = 45 - 30 * season + 10 * day + rng.normal(0, 4, n)
+    dwpf = tmpf - rng.gamma(2, 4, n)
+
+    data = {name: np.full(n, 'M', dtype=object) for name in IEM_COLUMNS}
+    data['station'] = np.full(n, station, dtype=object)
+    data['valid'] = valid.strftime('%Y-%m-%d %H:%M')
+    data['lon'] = np.full(n, lon)
+    data['lat'] = np.full(n, lat)
+    data['tmpf'] = tmpf.round(1)
+    data['dwpf'] = dwpf.round(1)
+    data['relh'] = np.clip(100 - 2.5 * (tmpf - dwpf), 5, 100).round(2)
+    data['drct'] = rng.integers(0, 36, n) * 10.0
+    data['sknt'] = rng.gamma(2, 4, n).round(0)
+    data['alti'] = rng.normal(30.0, 0.25, n).round(2)
+    data['vsby'] = 10.0
+    for i, name in enumerate(['skyc1', 'skyc2', 'skyc3', 'skyc4']):
+        # upper layers are more often missing, as in real reports
+        p = np.array([0.3, 0.2, 0.15, 0.15, 0.1, 0.01, 0.09]) if i == 0 else \
+            np.array([0.0, 0.1, 0.1, 0.1, 0.1, 0.0, 0.6])
+        data[name] = SKY_CODES[rng.choice(len(SKY_CODES), n, p=p / p.sum())]
+    data['metar'] = np.full(n, '%s 010015Z AUTO' % station, dtype=object)
+    df = pd.DataFrame(data, columns=IEM_COLUMNS)
+
+    # sprinkle missing values over the numeric fields
+    for name in ['tmpf', 'dwpf', 'relh', 'drct', 'sknt', 'alti']:
+        df[name] = df[name].astype(object)
+        df.loc[rng.random(n) < missing_fraction, name] = 'M'
+
+    preamble = ''.join('#DEBUG: %s\n' % line for line in
+                       ['Format Typ    -> comma', 'Time Period   -> %s %s' % (start, start + pd.Timedelta(days=days)),
+                        'Time Zone     -> Etc/UTC', 'Data Contact   -> synthetic', 'Entries Found -> %d' % n])
+    return preamble + df.to_csv(index=False)
+
+
+def stub_clearsky_ghi(lat, lon, elevation, times):
+    # a cheap clear-sky shape, the pipeline only needs something in W/m2 on the same index
+    hours = times.hour + times.minute / 60.0 + lon / 15.0
+    ghi = np.maximum(np.sin(np.pi * (hours - 6) / 12.0), 0) * 900
+    return pd.Series(ghi.astype(np.float32), index=times)
+
+
+def stations(n, seed=0):
+    # codes and coordinates spread over the continental US
+    rng = np.random.default_rng(seed)
+    return [('S%03d' % i, round(rng.uniform(30, 49), 4), round(rng.uniform(-120, -70), 4)) for i in range(n)]
+
+
+def clock(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_station(text):
+    """Seconds spent in each benchmarked function for one station csv"""
+    seconds = {}
+    raw = utils.read_metar_csv(io.StringIO(text))
+    met, seconds['make_metar_dataframe'] = clock(utils.make_metar_dataframe, raw)
+    _, seconds['make_metar_dataframe_local'] = clock(utils.make_metar_dataframe_local, raw)
+    lat, lon = utils.return_lat_lon(met)
+    fluxes, seconds['calc_fluxes'] = clock(utils.calc_fluxes, met, 2.0, lat, lon)
+    energy, seconds['build_energy_df'] = clock(utils.build_energy_df, *fluxes[:5])
+    _, seconds['calc_energy_df'] = clock(utils.calc_energy_df, met, 2.0, lat, lon)
+    _, seconds['plot_met'] = clock(utils.plot_met, met)
+    _, seconds['plot_historic_heat_fluxes'] = clock(utils.plot_historic_heat_fluxes, energy)
+    return seconds, len(raw)
+
+
+def run(days, n_stations, repeat=3, seed=0):
+    elevation.set_provider(lambda lat, lon: 300.0)
+    utils.get_clearsky_ghi = stub_clearsky_ghi
+
+    # warm up imports, the timezone finder and plotly on a day of data
+    run_station(synthetic_metar_csv('WARM', 41.12, -101.75, '2020-01-01', 1, seed))
+
+    totals = dict.fromkeys(FUNCTIONS, 0.0)
+    rows = 0
+    for i, (station, lat, lon) in enumerate(stations(n_stations, seed)):
+        text = synthetic_metar_csv(station, lat, lon, datetime.date(2000, 1, 1), days, seed + i)
+        # best of repeat for each function, the usual way to damp noise
+        best = None
+        for _ in range(repeat):
+            seconds, n = run_station(text)
+            best = seconds if best is None else {k: min(best[k], v) for k, v in seconds.items()}
+        for name in FUNCTIONS:
+            totals[name] += best[name]
+        rows += n
+    return totals, rows
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against a baseline run, returns the functions that regressed"""
+    if (baseline['days'], baseline['stations']) != (results['days'], results['stations']):
+        print('warning: baseline ran %s days x %s stations' % (baseline['days'], baseline['stations']))
+    regressed = []
+    print('\n%-28s %10s %10s %8s' % ('function', 'baseline', 'now', 'ratio'))
+    for name in FUNCTIONS:
+        before = baseline['seconds'].get(name)
+        now = results['seconds'][name]
+        if not before:
+            continue
+        ratio = now / before
+        flag = ''
+        if ratio > tolerance:
+            regressed.append(name)
+            flag = '  SLOWER'
+        print('%-28s %10.3f %10.3f %7.2fx%s' % (name, before, now, ratio, flag))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--days', type=float, default=365, help='length of each record, 1 to 7305 (20 years)')
+    parser.add_argument('--stations', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per station, the fastest counts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the results to this json file')
+    parser.add_argument('--baseline', help='json file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help='ratio to the baseline above which a function counts as slower')
+    args = parser.parse_args(argv)
+
+    totals, rows = run(args.days, args.stations, args.repeat, args.seed)
+    results = {'days': args.days, 'stations': args.stations, 'repeat': args.repeat, 'seed': args.seed,
+               'rows': rows, 'seconds': totals, 'environment': environment(),
+               'date': datetime.datetime.utcnow().isoformat(timespec='seconds')}
+
+    print('%g days x %d stations, %d METAR rows' % (args.days, args.stations, rows))
+    print('%-28s %10s %14s' % ('function', 'seconds', 'rows/s'))
+    for name in FUNCTIONS:
+        print('%-28s %10.3f %14.0f' % (name, totals[name], rows / max(totals[name], 1e-9)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            print('slower than the baseline: %s' % ', '.join(regressed))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Clear-sky GHI on a regular UTC grid, computed once per site and year.
+
+calc_fluxes only needs clear-sky GHI at the METAR times, which depend on
+nothing but the site. Each calendar year is computed with pvlib on a
+GRID_FREQ grid, kept in memory and saved under the cache root (the least
+recently used beyond MAX_CLEARSKY_BYTES are evicted), and then interpolated
+linearly to whatever (irregular) times are asked for.
+"""
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+from pvlib.location import Location
+
+import metar_cache
+import timing
+
+CLEARSKY_DIR = os.path.join(metar_cache.CACHE_ROOT, 'clearsky')
+# resolution of the precomputed grid, GHI is smooth enough at this spacing
+# for linear interpolation to stay within a few W/m2 of the exact value
+GRID_FREQ = '10min'
+# the least recently used site-years (about 210 kB each) are evicted beyond this size
+MAX_CLEARSKY_BYTES = 200 * 1024 ** 2
+
+
+def site_key(lat, lon, elevation):
+    return '%.4f_%.4f_%.0f' % (lat, lon, elevation)
+
+
+def year_grid(year):
+    # both ends included so interpolation works up to the last instant of the year
+    return pd.date_range('%d-01-01' % year, '%d-01-01' % (year + 1), freq=GRID_FREQ, tz='UTC')
+
+
+def index_ns(index):
+    # int64 nanoseconds since the epoch (UTC for tz-aware times) whatever the
+    # resolution of the index, pandas 2 indexes may be in s, ms or us;
+    # defined here rather than in utils, which imports this module
+    return index.as_unit('ns').asi8 if hasattr(index, 'as_unit') else index.asi8
+
+
+@functools.lru_cache(maxsize=64)
+def _year_ghi(key, year):
+    path = os.path.join(CLEARSKY_DIR, '%s_%d_%s.npy' % (key, year, GRID_FREQ))
+    try:
+        ghi = np.load(path)
+        # mark as recently used for eviction
+        os.utime(path)
+        return ghi
+    except (OSError, ValueError):
+        pass
+    lat, lon, elevation = (float(v) for v in key.split('_'))
+    site = Location(lat, lon, 'UTC', elevation, 'general location')
+    ghi = site.get_clearsky(year_grid(year)).ghi.to_numpy(dtype=np.float32)
+    os.makedirs(CLEARSKY_DIR, exist_ok=True)
+    # np.save adds .npy to names without it
+    tmp = metar_cache.temp_path(path[:-4]) + '.npy'
+    np.save(tmp, ghi)
+    os.replace(tmp, path)
+    metar_cache.track_write(path, MAX_CLEARSKY_BYTES, CLEARSKY_DIR)
+    return ghi
+
+
+@timing.timed('clearsky')
+def get_clearsky_ghi(lat, lon, elevation, times):
+    """Clear-sky GHI (W/m2) at times, interpolated from the cached yearly grids
+    Args:
+      lat, lon (float): site location
+      elevation (float): site elevation in m
+      times (DatetimeIndex): timezone aware times, any spacing
+    Returns:
+      pandas Series of GHI indexed by times
+    """
+    key = site_key(lat, lon, elevation)
+    utc = times.tz_convert('UTC')
+    if len(utc) == 0:
+        return pd.Series(np.array([], dtype=np.float32), index=times, name='ghi')
+    years = range(utc.min().year, utc.max().year + 1)
+    # neighbouring years share their Jan 1 00:00 point, keep it once
+    grid_x = np.concatenate([index_ns(year_grid(year))[:-1] for year in years]
+                            + [index_ns(year_grid(years[-1]))[-1:]])
+    grid_y = np.concatenate([_year_ghi(key, year)[:-1] for year in years] + [_year_ghi(key, years[-1])[-1:]])
+    ghi = np.interp(index_ns(utc), grid_x, grid_y).astype(np.float32)
+    return pd.Series(ghi, index=times, name='ghi')
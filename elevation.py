@@ -0,0 +1,106 @@
+"""
+Elevation lookups for calc_fluxes.
+
+get_elevation answers from, in order, an in-memory LRU, an optional station
+metadata table, the on-disk cache and finally the provider, which defaults
+to the opentopodata API. Coordinates are rounded to 4 decimals (~10 m) for
+all keys. Tests and offline runs can swap the provider with set_provider.
+"""
+import csv
+import functools
+import os
+import threading
+
+import requests
+
+import metar_cache
+import timing
+
+# coordinates -> elevation (m), persisted under the cache root
+ELEVATION_CACHE = 'elevations.json'
+# optional CSV with station, lat, lon and elevation (m) columns, e.g. exported
+# from the IEM station metadata for the ASOS networks used
+STATION_TABLE = os.environ.get('HEATFLUX_STATION_TABLE', '')
+OPENTOPODATA_URL = 'https://api.opentopodata.org/v1/ned10m?locations={lat},{lon}'
+REQUEST_TIMEOUT = 30
+
+_session = None
+_provider = None
+_station_elevations = None
+_disk = None
+_lock = threading.Lock()
+
+
+def round_key(lat, lon):
+    return '%.4f,%.4f' % (lat, lon)
+
+
+def opentopodata(lat, lon):
+    """Look up an elevation with the opentopodata API, reusing one HTTP session"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    result = _session.get(OPENTOPODATA_URL.format(lat=lat, lon=lon), timeout=REQUEST_TIMEOUT)
+    result.raise_for_status()
+    return result.json()['results'][0]['elevation']
+
+
+def load_station_table(path):
+    """Read a station metadata CSV into {rounded coordinates: elevation}"""
+    table = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('elevation') not in (None, ''):
+                table[round_key(float(row['lat']), float(row['lon']))] = float(row['elevation'])
+    return table
+
+
+def set_provider(provider=None, station_table=None):
+    """Swap the elevation source
+    Args:
+      provider (callable): provider(lat, lon) returning elevation in m,
+        None restores the opentopodata API
+      station_table (dict or string): {rounded coordinates: elevation} or the
+        path of a station CSV, None keeps STATION_TABLE
+    """
+    global _provider, _station_elevations
+    with _lock:
+        _provider = provider
+        if isinstance(station_table, str):
+            station_table = load_station_table(station_table)
+        _station_elevations = station_table
+    _lookup.cache_clear()
+
+
+@functools.lru_cache(maxsize=4096)
+def _lookup(key):
+    global _disk, _station_elevations
+    with _lock:
+        if _station_elevations is None:
+            _station_elevations = load_station_table(STATION_TABLE) if os.path.exists(STATION_TABLE) else {}
+        if key in _station_elevations:
+            return _station_elevations[key]
+        provider = _provider
+        if provider is None:
+            # the disk cache only holds answers from the default API
+            if _disk is None:
+                _disk = metar_cache.load_table(ELEVATION_CACHE)
+            if key in _disk:
+                return _disk[key]
+
+    lat, lon = (float(v) for v in key.split(','))
+    elevation = (provider or opentopodata)(lat, lon)
+    if elevation is None:
+        raise ValueError('No elevation available for %s' % key)
+
+    if provider is None:
+        with _lock:
+            _disk[key] = elevation
+            metar_cache.save_table(ELEVATION_CACHE, _disk)
+    return elevation
+
+
+@timing.timed('elevation')
+def get_elevation(lat, lon):
+    """Elevation (m) of a location, cached by coordinates rounded to 4 decimals"""
+    return _lookup(round_key(lat, lon))
@@ -0,0 +1,86 @@
+"""
+Columnar storage for processed met frames (make_metar_dataframe) and energy
+frames (build_energy_df).
+
+Parquet is compact and suited to archiving; Feather (Arrow IPC) is written
+uncompressed by default so read_frame can memory-map it without copying.
+Both keep the DatetimeIndex, including its timezone, through the pandas
+metadata pyarrow stores with the table.
+"""
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather', '.arrow': 'feather', '.csv': 'csv'}
+# columns kept in float64 by float32=True, coordinates need the precision
+FLOAT64_COLUMNS = ('lat', 'lon')
+
+
+def format_from_path(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError('Unknown output format %r, use one of %s' % (ext, ', '.join(sorted(FORMATS))))
+    return FORMATS[ext]
+
+
+def to_float32(df):
+    # cast float columns to float32, except FLOAT64_COLUMNS
+    columns = [col for col in df.columns if df[col].dtype == np.float64 and col not in FLOAT64_COLUMNS]
+    return df.astype({col: np.float32 for col in columns}) if columns else df
+
+
+def write_frame(df, path, fmt=None, float32=False, compression=None):
+    """Write a met or energy frame, the format is taken from the extension unless given.
+    compression defaults to snappy for Parquet and none for Feather."""
+    fmt = fmt or format_from_path(path)
+    if float32:
+        df = to_float32(df)
+    tmp = path + '.part'
+    if fmt == 'csv':
+        df.to_csv(tmp, index=True)
+    else:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        if fmt == 'parquet':
+            pq.write_table(table, tmp, compression=compression or 'snappy')
+        else:
+            feather.write_feather(table, tmp, compression=compression or 'uncompressed')
+    os.replace(tmp, path)
+
+
+def read_frame(path, fmt=None, columns=None, memory_map=True):
+    """Read a frame written by write_frame, memory-mapping the file where possible"""
+    fmt = fmt or format_from_path(path)
+    if fmt == 'csv':
+        # csv keeps only the UTC offsets, the index comes back in UTC
+        df = pd.read_csv(path, index_col=0)
+        df.index = pd.to_datetime(df.index, utc=True)
+        return df[columns] if columns else df
+    if fmt == 'parquet':
+        table = pq.read_table(path, columns=columns, memory_map=memory_map, use_pandas_metadata=True)
+    else:
+        # a memory-mapped Feather table costs nothing until columns are used
+        table = feather.read_table(path, memory_map=memory_map)
+        if columns:
+            index_columns = [c for c in table.schema.pandas_metadata['index_columns'] if isinstance(c, str)]
+            table = table.select(index_columns + [c for c in columns if c not in index_columns])
+    return table.to_pandas()
+
+
+def frame_to_bytes(df, fmt='parquet', float32=False):
+    """Serialize a frame in memory, for download buttons"""
+    if float32:
+        df = to_float32(df)
+    if fmt == 'csv':
+        return df.to_csv(index=True).encode('utf-8')
+    buf = io.BytesIO()
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    if fmt == 'parquet':
+        pq.write_table(table, buf)
+    else:
+        feather.write_feather(table, buf, compression='uncompressed')
+    return buf.getvalue()
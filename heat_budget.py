@@ -0,0 +1,156 @@
+"""
+Forward heat-budget model of water temperature.
+
+calc_fluxes needs the water temperature as an input. This module steps it
+forward instead: at each METAR time the same shortwave, longwave, latent and
+sensible formulations give q_net for the current water temperature, which
+then warms or cools a well-mixed layer of the given depth until the next
+time. The temperature never drops below the freeze-up floor (0 C).
+
+The terms that only depend on the weather are computed up front for the
+whole record. The time loop itself runs in a numba-compiled kernel when
+numba is installed. Without numba, a few columns are stepped with plain
+Python floats, one column at a time, and many columns are stepped together
+with NumPy, one time step per iteration; the per-step NumPy overhead only
+pays off from about PYTHON_MAX_COLUMNS stations/scenarios on.
+"""
+import numpy as np
+import pandas as pd
+
+from clearsky import get_clearsky_ghi, index_ns
+from elevation import get_elevation
+from utils import (
+    calc_solar,
+    calc_downwelling_LW,
+    calc_upwelling_LW,
+    calc_wind_function,
+    calc_latent_heat,
+    calc_sensible_heat,
+    calc_vapor_pressure,
+)
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+RHO_WATER = 1000  # kg/m3
+CP_WATER = 4186  # J/kg-K
+T_FREEZE = 0.0  # C
+# without numba, up to this many columns run through step_python, more through
+# step_numpy; they break even at about 20 columns
+PYTHON_MAX_COLUMNS = 16
+
+
+def step_numpy(dt, q_sw, q_atm, T_air, ea, P, f_U, T0, heat_capacity, T_freeze):
+    # all forcing arrays are (time x column), dt is (time,) in seconds, T0 and
+    # heat_capacity (J/m2-K) are (column,); returns the water temperature at the
+    # start of every time step
+    T = np.empty(q_sw.shape)
+    Tw = np.array(T0, dtype=np.float64)
+    for i in range(q_sw.shape[0]):
+        T[i] = Tw
+        q_net = (q_sw[i] + q_atm[i] - calc_upwelling_LW(Tw) + calc_sensible_heat(T_air[i], f_U[i], Tw)
+                 - calc_latent_heat(P[i], Tw, ea[i], f_U[i]))
+        # missing forcing holds the temperature
+        Tw = np.where(np.isnan(q_net), Tw, np.maximum(Tw + q_net * dt[i] / heat_capacity, T_freeze))
+    return T
+
+
+def step_python(dt, q_sw, q_atm, T_air, ea, P, f_U, T0, heat_capacity, T_freeze):
+    # same as step_numpy on Python floats, a column at a time
+    n, m = q_sw.shape
+    T = np.empty((n, m))
+    dt = dt.tolist()
+    for j in range(m):
+        Tw, hc = float(T0[j]), float(heat_capacity[j])
+        out = []
+        for i, (sw, atm, ta, e, p, f) in enumerate(zip(*(v[:, j].tolist() for v in (q_sw, q_atm, T_air, ea, P, f_U)))):
+            out.append(Tw)
+            q_net = sw + atm - calc_upwelling_LW(Tw) + calc_sensible_heat(ta, f, Tw) - calc_latent_heat(p, Tw, e, f)
+            # NaN forcing holds the temperature
+            if q_net == q_net:
+                Tw = max(Tw + q_net * dt[i] / hc, T_freeze)
+        T[:, j] = out
+    return T
+
+
+def _make_numba_kernel():
+    upwelling = numba.njit(calc_upwelling_LW)
+    latent = numba.njit(calc_latent_heat)
+    sensible = numba.njit(calc_sensible_heat)
+
+    @numba.njit
+    def kernel(dt, q_sw, q_atm, T_air, ea, P, f_U, T0, heat_capacity, T_freeze):
+        n, m = q_sw.shape
+        T = np.empty((n, m))
+        for j in range(m):
+            Tw = T0[j]
+            for i in range(n):
+                T[i, j] = Tw
+                q_net = (q_sw[i, j] + q_atm[i, j] - upwelling(Tw) + sensible(T_air[i, j], f_U[i, j], Tw)
+                         - latent(P[i, j], Tw, ea[i, j], f_U[i, j]))
+                if not np.isnan(q_net):
+                    Tw = max(Tw + q_net * dt[i] / heat_capacity[j], T_freeze)
+        return T
+
+    return kernel
+
+
+step_numba = _make_numba_kernel() if numba is not None else None
+
+
+def run_heat_budget(dt, q_sw, q_atm, T_air, ea, P, f_U, T0, depth, T_freeze=T_FREEZE, use_numba=None):
+    """
+    Step water temperature through precomputed forcing for many columns at once
+    (stations or scenarios sharing one time grid). Forcing arrays are
+    (time x column) or (time,), T0 and depth (m) are scalars or (column,).
+    Returns the (time x column) water temperature (C) at the start of each step.
+    """
+    q_sw, q_atm, T_air, ea, P, f_U = (np.asarray(v, dtype=np.float64) for v in (q_sw, q_atm, T_air, ea, P, f_U))
+    shape = np.broadcast_shapes(*(np.shape(v) if np.ndim(v) == 2 else (len(v), 1)
+                                  for v in (q_sw, q_atm, T_air, ea, P, f_U)))
+    q_sw, q_atm, T_air, ea, P, f_U = (np.ascontiguousarray(np.broadcast_to(v if v.ndim == 2 else v[:, None], shape))
+                                      for v in (q_sw, q_atm, T_air, ea, P, f_U))
+    T0 = np.broadcast_to(np.asarray(T0, dtype=np.float64), shape[1:]).copy()
+    heat_capacity = np.broadcast_to(RHO_WATER * CP_WATER * np.asarray(depth, dtype=np.float64), shape[1:]).copy()
+    dt = np.asarray(dt, dtype=np.float64)
+
+    if use_numba is None:
+        use_numba = step_numba is not None
+    if use_numba:
+        kernel = step_numba
+    else:
+        kernel = step_python if shape[1] <= PYTHON_MAX_COLUMNS else step_numpy
+    return kernel(dt, q_sw, q_atm, T_air, ea, P, f_U, T0, heat_capacity, float(T_freeze))
+
+
+def time_steps(index):
+    # seconds from each time to the next, the last time gets no step
+    return np.append(np.diff(index_ns(index)) / 1e9, 0.0)
+
+
+def simulate_water_temperature(df, lat, lon, depth, T0=4.0, a=10 ** -6, b=10 ** -6, c=1, R=1,
+                               elevation=None, T_freeze=T_FREEZE, use_numba=None):
+    """
+    Water temperature series for a decoded METAR frame (see make_metar_dataframe),
+    with the same flux formulations and wind-function coefficients as calc_fluxes.
+    depth is the mixed depth in m, T0 the water temperature at the first time.
+    The index is expected to be sorted; gaps in the forcing hold the temperature.
+    """
+    if elevation is None:
+        elevation = get_elevation(lat, lon)
+    ghi = get_clearsky_ghi(lat, lon, elevation, df.index).to_numpy()
+
+    solar_R = 0.15  # Maidment et al. (1996) Handbook of Hydrology
+    Cl = df['cloudiness'].to_numpy()
+    T_air = df['air_temperature_C'].to_numpy()
+    q_sw = calc_solar(ghi, solar_R, Cl)
+    q_atm = calc_downwelling_LW(T_air, Cl)
+    f_U = calc_wind_function(a, b, c, R, df['wind_speed_ms'].to_numpy())
+    ea = calc_vapor_pressure(df['dewpoint_C'].to_numpy())
+    P = df['atmospheric_pressure_mb'].to_numpy()
+
+    T = run_heat_budget(time_steps(df.index), q_sw, q_atm, T_air, ea, P, f_U, T0, depth,
+                        T_freeze=T_freeze, use_numba=use_numba)
+    return pd.Series(T[:, 0], index=df.index, name='water_temperature_C')
@@ -0,0 +1,159 @@
+"""
+Freezing degree-days, cumulative heat loss and ice-onset dates for many
+stations and winters at once.
+
+The decoded met frames (make_metar_dataframe) or energy frames
+(build_energy_df / calc_energy_df) of all stations are binned onto one
+shared time grid in a single np.bincount, giving a (station x time) block.
+Accumulating per winter, picking totals and finding the first time a
+threshold is crossed are then array operations over the whole block; the
+only Python loop is over winters.
+
+Winters are the ice season of aggregate.py (October to April, labelled by
+the year they start in), on the UTC calendar. Grid bins without any
+observation are filled forward from the last value for up to max_fill
+bins, longer gaps add nothing to the totals and show in 'coverage'.
+
+    met = {s: make_metar_dataframe(iter_metar_chunks(s, '20100101', '20200101')) for s in stations}
+    fdd = freezing_degree_days(met)
+    summary = winter_summary(met_frames=met, fdd_thresholds=(50, 100))
+"""
+import numpy as np
+import pandas as pd
+
+import timing
+from aggregate import winter_season
+from utils import index_ns
+
+# grid the stations are binned onto, and the longest gap filled forward (in bins)
+GRID_FREQ = '1h'
+MAX_FILL = 6
+# freezing degree-days count the degrees below this air temperature (C)
+T_BASE = 0.0
+FDD_THRESHOLDS = (25, 50, 100)
+# MJ/m^2 of net heat lost since the start of winter
+LOSS_THRESHOLDS = (100, 250, 500)
+
+
+@timing.timed('station_block')
+def station_block(frames, column, freq=GRID_FREQ, max_fill=MAX_FILL, times=None):
+    """
+    Bin one column of many station frames onto a shared grid.
+    frames maps station -> frame with a DatetimeIndex (naive means UTC).
+    The grid spans all the data unless times, a grid of bin starts at freq,
+    is given. Returns (times, stations, values) with values the
+    (station x time) bin means, NaN where a station has no data.
+    """
+    stations = list(frames)
+    t = np.concatenate([index_ns(frames[s].index) for s in stations])
+    v = np.concatenate([frames[s][column].to_numpy(dtype=np.float64, na_value=np.nan) for s in stations])
+    code = np.repeat(np.arange(len(stations)), [len(frames[s]) for s in stations])
+    step = pd.Timedelta(freq).value
+    ok = ~np.isnan(v)
+    if times is not None:
+        t0, n_times = times[0].value, len(times)
+        ok &= (t >= t0) & (t < t0 + n_times * step)
+    t, v, code = t[ok], v[ok], code[ok]
+    if times is None:
+        if not len(t):
+            raise ValueError('no %s data in any of the frames' % column)
+        t0 = t.min() // step * step
+        n_times = int((t.max() - t0) // step + 1)
+    bins = code * n_times + (t - t0) // step
+    size = len(stations) * n_times
+    total = np.bincount(bins, weights=v, minlength=size)
+    count = np.bincount(bins, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = (total / count).reshape(len(stations), n_times)
+
+    if max_fill:
+        values = pd.DataFrame(values.T).ffill(limit=max_fill).to_numpy().T
+    if times is None:
+        times = pd.date_range(pd.Timestamp(t0, unit='ns', tz='UTC'), periods=n_times, freq=freq)
+    return times, stations, values
+
+
+def cumulative_by_winter(increments, times):
+    """Running sum of (station x time) increments restarting every winter, NaN outside winters"""
+    season = winter_season(times)
+    x = np.where(np.isnan(increments), 0.0, increments)
+    cum = np.cumsum(x, axis=1)
+    # subtract the running total reached just before each run of equal season labels
+    change = np.diff(season, prepend=season[0] - 1) != 0
+    starts = np.flatnonzero(change)
+    base = np.where(starts > 0, cum[:, np.maximum(starts - 1, 0)], 0.0)
+    cum -= base[:, np.cumsum(change) - 1]
+    cum[:, season < 0] = np.nan
+    return cum
+
+
+def fdd_increments(values, freq=GRID_FREQ, T_base=T_BASE):
+    # degree-days below T_base contributed by each bin
+    return np.maximum(T_base - values, 0) * (pd.Timedelta(freq) / pd.Timedelta('1D'))
+
+
+def loss_increments(values, freq=GRID_FREQ):
+    # MJ/m^2 lost in each bin, negative when the water gains heat
+    return -values * pd.Timedelta(freq).total_seconds() / 1e6
+
+
+def freezing_degree_days(met_frames, freq=GRID_FREQ, T_base=T_BASE, max_fill=MAX_FILL):
+    """Cumulative freezing degree-days (C-days) per winter, a (time x station) DataFrame"""
+    times, stations, T_air = station_block(met_frames, 'air_temperature_C', freq, max_fill)
+    cum = cumulative_by_winter(fdd_increments(T_air, freq, T_base), times)
+    return pd.DataFrame(cum.T, index=times, columns=stations)
+
+
+def cumulative_heat_loss(energy_frames, freq=GRID_FREQ, max_fill=MAX_FILL):
+    """Cumulative net heat loss (MJ/m^2) per winter, a (time x station) DataFrame"""
+    times, stations, q_net = station_block(energy_frames, 'net flux', freq, max_fill)
+    cum = cumulative_by_winter(loss_increments(q_net, freq), times)
+    return pd.DataFrame(cum.T, index=times, columns=stations)
+
+
+def winter_totals(values, cum, times, prefix, thresholds, freq):
+    # per winter: final total, coverage and the first time each threshold is reached
+    season = winter_season(times)
+    step = pd.Timedelta(freq)
+    out = {}
+    for winter in np.unique(season[season >= 0]):
+        cols = np.flatnonzero(season == winter)
+        block = cum[:, cols]
+        label = '%d-%d' % (winter, winter + 1)
+        columns = {prefix: block[:, -1],
+                   '%s coverage' % prefix: (~np.isnan(values[:, cols])).mean(axis=1)}
+        for threshold in thresholds:
+            crossed = block >= threshold
+            first = times[cols][crossed.argmax(axis=1)] + step
+            columns['%s >= %g' % (prefix, threshold)] = first.where(crossed.any(axis=1))
+        out[label] = columns
+    return out
+
+
+def winter_summary(met_frames=None, energy_frames=None, fdd_thresholds=FDD_THRESHOLDS,
+                   loss_thresholds=LOSS_THRESHOLDS, freq=GRID_FREQ, T_base=T_BASE, max_fill=MAX_FILL):
+    """
+    One row per (station, winter): total freezing degree-days from met frames
+    and/or total net heat loss from energy frames, their coverage (fraction of
+    grid bins with data) and the date each threshold was first reached (NaT if
+    never).
+    """
+    parts = []
+    if met_frames:
+        times, stations, T_air = station_block(met_frames, 'air_temperature_C', freq, max_fill)
+        cum = cumulative_by_winter(fdd_increments(T_air, freq, T_base), times)
+        parts.append((stations, winter_totals(T_air, cum, times, 'FDD (C-days)', fdd_thresholds, freq)))
+    if energy_frames:
+        times, stations, q_net = station_block(energy_frames, 'net flux', freq, max_fill)
+        cum = cumulative_by_winter(loss_increments(q_net, freq), times)
+        parts.append((stations, winter_totals(q_net, cum, times, 'heat loss (MJ/m^2)', loss_thresholds, freq)))
+    if not parts:
+        raise ValueError('pass met_frames and/or energy_frames')
+
+    tables = []
+    for stations, totals in parts:
+        frames = [pd.DataFrame(columns, index=pd.MultiIndex.from_product([stations, [label]],
+                                                                         names=['station', 'winter']))
+                  for label, columns in totals.items()]
+        tables.append(pd.concat(frames).sort_index())
+    return pd.concat(tables, axis=1)
@@ -2,20 +2,193 @@
 Example script that scrapes data from the IEM ASOS download service
 """
 from __future__ import print_function
+import collections
 import json
+import os
+import random
 import time
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import timing
 
 # Python 2 and 3: alternative 4
 try:
     from urllib.request import urlopen
+    from urllib.parse import urlparse
+    from urllib.error import HTTPError
 except ImportError:
-    from urllib2 import urlopen
+    from urllib2 import urlopen, HTTPError
+    from urlparse import urlparse
 
 # Number of attempts to download data
 MAX_ATTEMPTS = 6
 # HTTPS here can be problematic for installs that don't have Lets Encrypt CA
 SERVICE = "http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?"
+# The IEM throttles clients that open too many connections at once, so every
+# fetch holds one of these slots for its host while it is talking to it
+HOST_CONCURRENCY = 4
+# Number of stations fetched at the same time by download_stations
+MAX_WORKERS = 8
+# Size of the blocks streamed from the socket to disk
+CHUNK_SIZE = 64 * 1024
+# Backoff after a failed attempt: BACKOFF_BASE * 2**attempt seconds capped at
+# BACKOFF_MAX, of which the upper half is randomized so workers don't retry in step
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+# HTTP status codes worth retrying, anything else (e.g. 400, 404) fails at once
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Requests per second started by this process, and the burst allowed on top
+RATE_LIMIT = 1.0
+RATE_BURST = 4
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+# Timing of the most recent download attempts, newest last
+Attempt = collections.namedtuple(
+    "Attempt", ["uri", "attempt", "queued", "elapsed", "nbytes", "outcome", "backoff"])
+attempt_log = collections.deque(maxlen=1000)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket, acquire() blocks until a token is available"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# shared by every fetch in the process
+rate_limiter = TokenBucket(RATE_LIMIT, RATE_BURST)
+
+
+class RetryableError(Exception):
+    """The service answered, but asked us to come back later"""
+
+    def __init__(self, message, retry_after=None):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait after the given (zero based) failed attempt"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def host_slot(uri):
+    """Return the semaphore limiting concurrent requests to the host of uri"""
+    host = urlparse(uri).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+        return _host_slots[host]
+
+
+def build_uri(station, startts, endts):
+    """Build the IEM request for one station, endts is exclusive
+    The hour and minute of startts and endts narrow the request within a day.
+    """
+    service = SERVICE + "data=all&tz=Etc/UTC&format=comma&latlon=yes&"
+
+    service += startts.strftime("year1=%Y&month1=%m&day1=%d&hour1=%H&minute1=%M&")
+    service += endts.strftime("year2=%Y&month2=%m&day2=%d&hour2=%H&minute2=%M&")
+
+    return "%s&station=%s" % (service, station)
+
+
+def fetch_with_retry(uri, consume):
+    """Open uri and hand the response to consume, retrying with backoff
+    Every attempt first waits for the shared rate limiter and a slot for the
+    host, and is recorded in attempt_log.
+    Args:
+      uri (string): URL to fetch
+      consume (callable): consume(response) returns (result, nbytes) and
+        raises RetryableError if the body is an error message
+    Returns:
+      the result of consume, or None once all attempts are exhausted
+    """
+    # the whole call, including waits and backoff, is one "download" stage
+    with timing.stage("download") as info:
+        for attempt in range(MAX_ATTEMPTS):
+            queued = time.monotonic()
+            rate_limiter.acquire()
+            retry_after = None
+            nbytes = 0
+            with host_slot(uri):
+                started = time.monotonic()
+                try:
+                    with urlopen(uri, timeout=300) as response:
+                        result, nbytes = consume(response)
+                    outcome = "ok"
+                except HTTPError as exp:
+                    outcome = "HTTP %s" % exp.code
+                    if exp.code not in RETRY_STATUS:
+                        attempt_log.append(Attempt(
+                            uri, attempt, started - queued, time.monotonic() - started, 0, outcome, 0))
+                        print("download(%s) failed with %s, not retrying" % (uri, exp))
+                        return None
+                    retry_after = exp.headers.get("Retry-After") if exp.headers else None
+                    retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                except RetryableError as exp:
+                    outcome = str(exp)
+                    retry_after = exp.retry_after
+                except Exception as exp:
+                    outcome = "%s: %s" % (type(exp).__name__, exp)
+            elapsed = time.monotonic() - started
+
+            if outcome == "ok":
+                attempt_log.append(Attempt(uri, attempt, started - queued, elapsed, nbytes, outcome, 0))
+                info["bytes"] = nbytes
+                return result
+
+            backoff = backoff_delay(attempt, retry_after) if attempt + 1 < MAX_ATTEMPTS else 0
+            attempt_log.append(Attempt(uri, attempt, started - queued, elapsed, nbytes, outcome, backoff))
+            print("download(%s) failed with %s, retrying in %.1fs" % (uri, outcome, backoff))
+            time.sleep(backoff)
+
+        print("Exhausted attempts to download %s" % (uri,))
+        return None
+
+
+def month_ranges(startts, endts):
+    """Split [startts, endts) into calendar month sized [start, end) pieces
+    Long requests are slow for the IEM to serve and tend to hit the timeout,
+    a month of one station is a few MB at most.
+    """
+    start = startts
+    while start < endts:
+        first = start.replace(day=1)
+        if isinstance(first, datetime.datetime):
+            # a start within a day still ends at the next midnight of the 1st
+            first = first.replace(hour=0, minute=0, second=0, microsecond=0)
+        if start.month == 12:
+            end = first.replace(year=start.year + 1, month=1)
+        else:
+            end = first.replace(month=start.month + 1)
+        end = min(end, endts)
+        yield start, end
+        start = end
 
 
 def download_data(uri):
@@ -28,19 +201,85 @@ def download_data(uri):
     Returns:
       string data
     """
-    attempt = 0
-    while attempt < MAX_ATTEMPTS:
-        try:
-            data = urlopen(uri, timeout=300).read().decode("utf-8")
-            if data is not None and not data.startswith("ERROR"):
-                return data
-        except Exception as exp:
-            print("download_data(%s) failed with %s" % (uri, exp))
-            time.sleep(5)
-        attempt += 1
+    def consume(response):
+        raw = response.read()
+        data = raw.decode("utf-8")
+        if data.startswith("ERROR"):
+            raise RetryableError(data.splitlines()[0])
+        return data, len(raw)
 
-    print("Exhausted attempts to download, returning empty data")
-    return ""
+    data = fetch_with_retry(uri, consume)
+    if data is None:
+        print("Download failed, returning empty data")
+        return ""
+    return data
+
+
+def download_to_file(uri, outfn):
+    """Stream the data from the IEM straight to disk
+    Same retry rules as download_data, but the response is never held in
+    memory as a whole. The file only appears under outfn once complete.
+    Args:
+      uri (string): URL to fetch
+      outfn (string): file to write
+    Returns:
+      True if the file was written, False if the download came back empty
+      and None if it failed
+    """
+    tmpfn = outfn + ".part"
+
+    def consume(response):
+        chunk = response.read(CHUNK_SIZE)
+        if chunk.startswith(b"ERROR"):
+            raise RetryableError(chunk.decode("utf-8", "replace").splitlines()[0])
+        if not chunk:
+            # nothing to write, an empty file would look like a finished download
+            print("download(%s) returned no data" % (uri,))
+            return False, 0
+        nbytes = 0
+        with open(tmpfn, "wb") as out:
+            while chunk:
+                out.write(chunk)
+                nbytes += len(chunk)
+                chunk = response.read(CHUNK_SIZE)
+        os.replace(tmpfn, outfn)
+        return True, nbytes
+
+    return fetch_with_retry(uri, consume)
+
+
+def download_stations(stations, startts, endts, outdir=".", max_workers=None):
+    """Download many stations in parallel, writing one file per station
+    Stations that already have a complete file in outdir are skipped, so an
+    interrupted run can simply be restarted.
+    Args:
+      stations (list): station identifiers
+      startts, endts (datetime): UTC period, endts is exclusive
+      outdir (string): directory to write the files to
+      max_workers (int): number of stations in flight, defaults to MAX_WORKERS
+    Returns:
+      dict of station -> file name, None for stations that failed
+    """
+    os.makedirs(outdir, exist_ok=True)
+    results = {}
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_WORKERS) as pool:
+        for station in stations:
+            outfn = os.path.join(outdir, "%s_%s_%s.txt" % (
+                station,
+                startts.strftime("%Y%m%d%H%M"),
+                endts.strftime("%Y%m%d%H%M"),
+            ))
+            if os.path.exists(outfn):
+                results[station] = outfn
+                continue
+            uri = build_uri(station, startts, endts)
+            jobs[timing.submit(pool, download_to_file, uri, outfn)] = (station, outfn)
+        for future in as_completed(jobs):
+            station, outfn = jobs[future]
+            results[station] = outfn if future.result() else None
+            print("Downloaded: %s (%d/%d)" % (station, len(results), len(stations)))
+    return results
 
 
 def get_stations_from_filelist(filename):
@@ -59,25 +298,9 @@ def main():
     startts = datetime.datetime(2012, 8, 1)
     endts = datetime.datetime(2012, 9, 1)
 
-    service = SERVICE + "data=all&tz=Etc/UTC&format=comma&latlon=yes&"
-
-    service += startts.strftime("year1=%Y&month1=%m&day1=%d&")
-    service += endts.strftime("year2=%Y&month2=%m&day2=%d&")
-
     stations=['OGA']
     #stations = get_stations_from_filelist("mystations.txt")
-    for station in stations:
-        uri = "%s&station=%s" % (service, station)
-        print("Downloading: %s" % (station,))
-        data = download_data(uri)
-        outfn = "%s_%s_%s.txt" % (
-            station,
-            startts.strftime("%Y%m%d%H%M"),
-            endts.strftime("%Y%m%d%H%M"),
-        )
-        out = open(outfn, "w")
-        out.write(data)
-        out.close()
+    download_stations(stations, startts, endts)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+"""
+Incremental ("live") processing of one station for near-real-time dashboards.
+
+The decoded met frame, the energy frame and the last processed observation
+time are kept per station under the cache root. update_live only asks the
+IEM for what was reported since that time, decodes and computes fluxes for
+the observations that are actually new and appends them, trimming
+everything older than the lookback window. If part of the download fails
+nothing is stored, so the next update asks for the same period again.
+"""
+import datetime
+import json
+import os
+
+import pandas as pd
+
+import metar_cache
+from flux_io import read_frame, write_frame
+from utils import (
+    iter_metar_chunks,
+    make_metar_dataframe_local,
+    calc_fluxes,
+    build_energy_df,
+    return_lat_lon,
+    get_elevation,
+)
+
+LIVE_DIR = os.path.join(metar_cache.CACHE_ROOT, 'live')
+
+
+def live_paths(station):
+    stem = os.path.join(LIVE_DIR, station.upper())
+    return {'state': os.path.join(stem, 'state.json'),
+            'met': os.path.join(stem, 'met.parquet'),
+            'energy': os.path.join(stem, 'energy.parquet')}
+
+
+def load_live(station):
+    """Return (state, met_df, energy_df) for a station, (None, None, None) if it has none"""
+    paths = live_paths(station)
+    try:
+        with open(paths['state']) as f:
+            state = json.load(f)
+        return state, read_frame(paths['met']), read_frame(paths['energy'])
+    except (OSError, ValueError):
+        return None, None, None
+
+
+def save_live(station, state, met_df, energy_df):
+    paths = live_paths(station)
+    os.makedirs(os.path.dirname(paths['state']), exist_ok=True)
+    write_frame(met_df, paths['met'])
+    write_frame(energy_df, paths['energy'])
+    # the state goes last, it only points at frames that are fully written
+    tmp = paths['state'] + '.part'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, paths['state'])
+
+
+def _fetch(station, start, end):
+    # naive UTC datetimes, end exclusive; raises IOError if any month failed
+    chunks = iter_metar_chunks(station, start, end, use_cache=False)
+    return make_metar_dataframe_local(chunks)
+
+
+def update_live(station, lookback_days=10, T_water_C=2.0, a=10 ** -6, b=10 ** -6, c=1, R=1, now=None):
+    """
+    Bring the stored met and energy frames of a station up to date and return them.
+    A change of parameters or lookback recomputes the whole window once.
+    Returns (met_df, energy_df, n_new) where n_new is the number of new observations.
+    Raises IOError if the download failed, the stored frames are then left as they were.
+    """
+    now = now or datetime.datetime.utcnow()
+    params = {'lookback_days': lookback_days, 'T_water_C': T_water_C, 'a': a, 'b': b, 'c': c, 'R': R}
+    window_start = pd.Timestamp(now - datetime.timedelta(days=lookback_days), tz='UTC')
+    tomorrow = datetime.datetime.combine((now + datetime.timedelta(days=1)).date(), datetime.time())
+
+    state, met_df, energy_df = load_live(station)
+    if state is None or state['params'] != params:
+        new_met = _fetch(station, datetime.datetime.combine(window_start.date(), datetime.time()), tomorrow)
+        met_df = new_met.iloc[:0]
+        energy_df = None
+        state = {'params': params}
+    else:
+        last_valid = pd.Timestamp(state['last_valid'])
+        new_met = _fetch(station, last_valid.tz_convert('UTC').tz_localize(None).to_pydatetime(), tomorrow)
+        new_met = new_met[new_met.index > last_valid]
+
+    if len(new_met):
+        if 'elevation' not in state:
+            state['lat'], state['lon'] = (float(v) for v in return_lat_lon(new_met))
+            state['elevation'] = float(get_elevation(state['lat'], state['lon']))
+        q_sw, q_atm, q_b, q_l, q_h, q_net = calc_fluxes(new_met, T_water_C, state['lat'], state['lon'], a, b, c, R,
+                                                        elevation=state['elevation'])
+        new_energy = build_energy_df(q_sw, q_atm, q_b, q_l, q_h)
+        met_df = pd.concat([met_df, new_met]) if len(met_df) else new_met
+        energy_df = pd.concat([energy_df, new_energy]) if energy_df is not None else new_energy
+        state['last_valid'] = met_df.index.max().isoformat()
+
+    if energy_df is None:
+        # nothing reported in the window yet
+        return met_df, pd.DataFrame(), 0
+
+    met_df = met_df[met_df.index >= window_start]
+    energy_df = energy_df[energy_df.index >= window_start]
+    save_live(station, state, met_df, energy_df)
+    return met_df, energy_df, len(new_met)
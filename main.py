@@ -10,7 +10,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from utils import (
-    get_metar,
+    iter_metar_chunks,
     make_metar_dataframe_local,
     calc_fluxes,
     build_energy_df,
@@ -18,9 +18,11 @@ from utils import (
     plot_met,
     plot_historic_heat_fluxes,
 )
-import pandas as pd
 import datetime
-import io
+import time
+from flux_io import frame_to_bytes
+from live import update_live
+import background
 
 # Function to calculate start and end dates for the 10-day lookback
 def get_lookback_dates(days=10):
@@ -28,14 +30,154 @@ def get_lookback_dates(days=10):
     start_date = end_date - datetime.timedelta(days=days)
     return start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d")
 
-# Cache the data processing to improve performance
-@st.cache_data
-def st_make_metar_dataframe(df):
-    return make_metar_dataframe_local(df)
-
-@st.cache_data
-def convert_df(df):
-    return df.to_csv(index=True).encode('utf-8')
+# live mode results are reused for this long, new reports arrive every 5 to 60 minutes
+LIVE_REFRESH_MINUTES = 5
+
+# The pipelines run in background.py's worker threads, the script only starts
+# them and shows how far they are, so the page stays responsive and a widget
+# change doesn't start over
+FLUX_STAGES = ['Downloading and decoding METAR data', 'Plotting met data', 'Calculating heat fluxes',
+               'Plotting heat fluxes', 'Preparing downloads']
+LIVE_STAGES = ['Updating live data', 'Plotting heat fluxes', 'Plotting met data']
+
+def flux_export(energy_df):
+    tz_label = str(energy_df.index.tz) if energy_df.index.tz else 'UTC'
+    flux_export = energy_df.rename(columns={
+        'downwelling SW': 'Downwelling Shortwave Radiation (W/m^2)',
+        'downwelling LW': 'Downwelling Longwave Radiation (W/m^2)',
+        'upwelling LW': 'Upwelling Longwave Radiation (W/m^2)',
+        'sensible heat': 'Sensible Heat Flux (W/m^2)',
+        'latent heat': 'Latent Heat Flux (W/m^2)',
+        'net flux': 'Net Heat Flux (W/m^2)',
+    }).rename_axis(f'datetime ({tz_label})')
+    flux_export.index = flux_export.index.tz_localize(None)
+    flux_export = flux_export.round(4)
+    date_start = flux_export.index.min().strftime("%Y%m%d")
+    date_end = flux_export.index.max().strftime("%Y%m%d")
+    flux_csv = flux_export.to_csv().encode('utf-8-sig')
+    return flux_csv, frame_to_bytes(energy_df, 'parquet'), date_start, date_end
+
+# Each stage is cached on small keys (see background.py), so only the stages
+# whose inputs changed re-run: a new water temperature reuses the download,
+# decode and met plot. They run in the job threads, where there is no page
+# to show a spinner on
+@st.cache_data(max_entries=32, show_spinner=False)
+def st_make_metar_dataframe(station, startts, endts, refresh=0, _job=None):
+    chunks = []
+    # the download is parsed month by month, cancelling stops between months
+    for chunk in iter_metar_chunks(station, startts, endts):
+        if _job is not None:
+            _job.check()
+        chunks.append(chunk)
+    return make_metar_dataframe_local(chunks)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def st_plot_met(station, startts, endts, refresh):
+    return plot_met(st_make_metar_dataframe(station, startts, endts, refresh))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def st_calc_energy(station, startts, endts, refresh, T_water_C):
+    processed_df = st_make_metar_dataframe(station, startts, endts, refresh)
+    airport_lat, airport_lon = return_lat_lon(processed_df)
+    q_sw, q_atm, q_b, q_l, q_h, q_net = calc_fluxes(processed_df, T_water_C, airport_lat, airport_lon)
+    return build_energy_df(q_sw, q_atm, q_b, q_l, q_h)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def st_plot_fluxes(station, startts, endts, refresh, T_water_C):
+    return plot_historic_heat_fluxes(st_calc_energy(station, startts, endts, refresh, T_water_C))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def st_flux_export(station, startts, endts, refresh, T_water_C):
+    return flux_export(st_calc_energy(station, startts, endts, refresh, T_water_C))
+
+def flux_pipeline(job, station, startts, endts, refresh, T_water_C):
+    met_key = (station, startts, endts, refresh)
+    job.begin(FLUX_STAGES[0])
+    job.finish(FLUX_STAGES[0], met_df=st_make_metar_dataframe(*met_key, _job=job))
+
+    job.begin(FLUX_STAGES[1])
+    job.finish(FLUX_STAGES[1], fig_met=st_plot_met(*met_key))
+
+    job.begin(FLUX_STAGES[2])
+    job.finish(FLUX_STAGES[2], energy_df=st_calc_energy(*met_key, T_water_C))
+
+    job.begin(FLUX_STAGES[3])
+    job.finish(FLUX_STAGES[3], fig_flux=st_plot_fluxes(*met_key, T_water_C))
+
+    job.begin(FLUX_STAGES[4])
+    job.finish(FLUX_STAGES[4], export=st_flux_export(*met_key, T_water_C))
+
+def live_pipeline(job, station, lookback_days, T_water_C):
+    job.begin(LIVE_STAGES[0])
+    met_df, energy_df, n_new = update_live(station, lookback_days=lookback_days, T_water_C=T_water_C)
+    job.finish(LIVE_STAGES[0], met_df=met_df, energy_df=energy_df,
+               summary=f"**{n_new} new observations**, last observation {met_df.index.max()}")
+
+    job.begin(LIVE_STAGES[1])
+    job.finish(LIVE_STAGES[1], fig_flux=plot_historic_heat_fluxes(energy_df))
+
+    job.begin(LIVE_STAGES[2])
+    job.finish(LIVE_STAGES[2], fig_met=plot_met(met_df))
+
+def show_timings(rec):
+    # wall time, rows and bytes per pipeline stage of the last run
+    with st.expander("Timings"):
+        st.text(rec.summary())
+        st.json(rec.to_dict(), expanded=False)
+
+def show_job(job, station):
+    # progress and results of the session's job, results appear as soon as
+    # their stage is done and the page is updated until the job finishes
+    status = st.empty()
+    bar = st.progress(0.0)
+    cancel = st.empty()
+    if not job.done and cancel.button("Cancel"):
+        job.cancel()
+    areas = {name: st.empty() for name in ['summary', 'fig_flux', 'export', 'fig_met']}
+    shown = set()
+    while True:
+        fraction, text = job.progress()
+        status.write(text)
+        bar.progress(fraction)
+        results = job.snapshot()
+        for name in [name for name in areas if name in results and name not in shown]:
+            with areas[name].container():
+                if name == 'summary':
+                    st.write(results['summary'])
+                elif name == 'fig_flux':
+                    st.subheader("Modeled Heat Flux Results Plots")
+                    st.plotly_chart(results['fig_flux'], use_container_width=True)
+                elif name == 'export':
+                    # Download buttons for the energy flux data
+                    flux_csv, flux_parquet, date_start, date_end = results['export']
+                    st.download_button(
+                        label="Download Energy Flux Data as CSV",
+                        data=flux_csv,
+                        file_name=f"{station}_energy_flux_{date_start}_{date_end}.csv",
+                        mime="text/csv",
+                    )
+                    st.download_button(
+                        label="Download Energy Flux Data as Parquet",
+                        data=flux_parquet,
+                        file_name=f"{station}_energy_flux_{date_start}_{date_end}.parquet",
+                        mime="application/octet-stream",
+                    )
+                else:
+                    st.subheader("Meteorological Data Plots - Decoded from")
+                    st.plotly_chart(results['fig_met'], use_container_width=True)
+            shown.add(name)
+        if job.done:
+            break
+        time.sleep(0.5)
+    cancel.empty()
+
+    if job.error is not None:
+        st.error(f"An error occurred: {job.error}")
+    elif job.cancelled:
+        st.warning("Cancelled.")
+    else:
+        st.success("Heat flux calculations and plots generated successfully.")
+    show_timings(job.timings)
 
 st.set_page_config(page_title="Historic Modeled Heat Flux", layout="wide")
 
@@ -54,72 +196,27 @@ T_water_C = st.number_input('water temperature (C)', value=2)
 
 lookback_days = st.number_input('Time Period to Look Back (days)', value=10)
 
-if st.button("Go"):
-    with st.spinner("Processing..."):
-        try:
-            # Step 1: Calculate Date Range
-            startts, endts = get_lookback_dates(days=lookback_days)
-            st.write(f"**Date Range:** {startts} to {endts}")
-
-            # Step 2: Download METAR Data
-            data = get_metar(airport_code, startts, endts)
-
-            # Convert raw data to DataFrame
-            raw_df = pd.read_csv(io.StringIO(data), skiprows=5, na_values=["M"])
-
-            # Step 3: Process METAR Data
-            processed_df = st_make_metar_dataframe(raw_df)
-
-            # # Display Processed Data
-            # st.subheader("Processed Meteorological Data")
-            # st.write(processed_df)
-
-            # Step 5: Calculate Heat Fluxes
-            #T_water_C = 3.0  
-            airport_lat, airport_lon = return_lat_lon(processed_df)
-            q_sw, q_atm, q_b, q_l, q_h, q_net = calc_fluxes(
-                processed_df, T_water_C, airport_lat, airport_lon
-            )
-            energy_df = build_energy_df(q_sw, q_atm, q_b, q_l, q_h)
-
-            # # Display Heat Flux Data
-            # st.subheader("Calculated Heat Fluxes")
-            # st.write(energy_df)
-
-            # Step 6: Plot Heat Flux Results
-            st.subheader("Modeled Heat Flux Results Plots")
-            fig_flux = plot_historic_heat_fluxes(energy_df)
-            st.plotly_chart(fig_flux, use_container_width=True)
-            #st.pyplot(fig_flux)
-
-            # Download button for energy flux CSV
-            tz_label = str(energy_df.index.tz) if energy_df.index.tz else 'UTC'
-            flux_export = energy_df.rename(columns={
-                'downwelling SW': 'Downwelling Shortwave Radiation (W/m^2)',
-                'downwelling LW': 'Downwelling Longwave Radiation (W/m^2)',
-                'upwelling LW': 'Upwelling Longwave Radiation (W/m^2)',
-                'sensible heat': 'Sensible Heat Flux (W/m^2)',
-                'latent heat': 'Latent Heat Flux (W/m^2)',
-                'net flux': 'Net Heat Flux (W/m^2)',
-            }).rename_axis(f'datetime ({tz_label})')
-            flux_export.index = flux_export.index.tz_localize(None)
-            flux_export = flux_export.round(4)
-            date_start = flux_export.index.min().strftime("%Y%m%d")
-            date_end = flux_export.index.max().strftime("%Y%m%d")
-            flux_csv = flux_export.to_csv().encode('utf-8-sig')
-            st.download_button(
-                label="Download Energy Flux Data as CSV",
-                data=flux_csv,
-                file_name=f"{airport_code}_energy_flux_{date_start}_{date_end}.csv",
-                mime="text/csv",
-            )
-
-            # Step 4: Plot Meteorological Data
-            st.subheader("Meteorological Data Plots - Decoded from")
-            fig_met = plot_met(processed_df)
-            st.plotly_chart(fig_met, use_container_width=True)
-
-            st.success("Heat flux calculations and plots generated successfully.")
-
-        except Exception as e:
-            st.error(f"An error occurred: {e}")
+live_mode = st.checkbox('Live mode: keep the results on disk and only process observations since the last run')
+
+run_clicked = st.button("Go")
+
+if run_clicked:
+    previous = st.session_state.get('job')
+    if previous is not None:
+        previous.cancel()
+    if live_mode:
+        # update_live itself only processes what is new, a run is reused for LIVE_REFRESH_MINUTES
+        key = ('live', airport_code, lookback_days, T_water_C, int(time.time() // (LIVE_REFRESH_MINUTES * 60)))
+        job = background.submit(key, LIVE_STAGES, live_pipeline, airport_code, lookback_days, T_water_C)
+    else:
+        startts, endts = get_lookback_dates(days=lookback_days)
+        key = ('flux', airport_code, startts, endts, background.refresh_bucket(endts), T_water_C)
+        job = background.submit(key, FLUX_STAGES, flux_pipeline, *key[1:])
+    st.session_state['job'] = job
+    st.session_state['job_station'] = airport_code
+
+if 'job' in st.session_state:
+    job = st.session_state['job']
+    if job.key[0] == 'flux':
+        st.write(f"**Date Range:** {job.key[2]} to {job.key[3]}")
+    show_job(job, st.session_state['job_station'])
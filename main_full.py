@@ -12,22 +12,92 @@
 # --
 
 import streamlit as st
-from utils import get_metar, make_metar_dataframe, calc_fluxes, build_energy_df, plot_historic_heat_fluxes, return_lat_lon, plot_met
-import pandas as pd
+from utils import get_metar, merge_metar, read_metar_csv, read_water_temperature_csv, make_metar_dataframe, calc_fluxes, build_energy_df, plot_historic_heat_fluxes, return_lat_lon, plot_met
+import datetime
+import hashlib
+import time
+from flux_io import frame_to_bytes
+from aggregate import daily_sums, summarize, rolling_net_flux
+from qc import clean_met
+import timing
+import background
+import iowa_metar_scrape as ia
 
 
-#@st.cache_data
-def st_make_metar_dataframe(df):
-    return make_metar_dataframe(df)
+def file_key(uploaded_file):
+    # uploads are identified by their content, so re-uploading the same file hits the cache
+    return hashlib.md5(uploaded_file.getvalue()).hexdigest()
 
 
-@st.cache_data
-def convert_df(df):
-    return df.to_csv(index=True).encode('utf-8')
+def download_pipeline(job, station, months):
+    # one stage per month, so the progress moves and cancelling stops between months
+    pieces = []
+    for stage, (start, end) in months.items():
+        job.begin(stage)
+        pieces.append(get_metar(station, start.strftime('%Y%m%d'), end.strftime('%Y%m%d')))
+        job.finish(stage, **({'data': merge_metar(pieces)} if len(pieces) == len(months) else {}))
+
+
+def start_download(station, startts, endts):
+    months = {'Downloading %s' % start.strftime('%b %Y'): (start, end) for start, end in ia.month_ranges(
+        datetime.datetime.strptime(startts, '%Y%m%d'), datetime.datetime.strptime(endts, '%Y%m%d'))}
+    key = ('metar', station, startts, endts, background.refresh_bucket(endts))
+    return background.submit(key, list(months), download_pipeline, station, months)
+
+
+# Each stage is cached on small keys, see background.py
+@st.cache_data(max_entries=16, show_spinner=False)
+def st_make_metar_dataframe(raw_key, grid, _df):
+    df = make_metar_dataframe(_df)
+    if grid:
+        df = clean_met(df, grid)
+    return df
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def st_calc_energy(met_key, water_key, lat, lon, a, b, c, R, _df, _T_water_C):
+    q_sw, q_atm, q_b, q_l, q_h, q_net = calc_fluxes(_df, _T_water_C, lat, lon, a, b, c, R)
+    return build_energy_df(q_sw, q_atm, q_b, q_l, q_h)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def convert_df(key, _df):
+    return _df.to_csv(index=True).encode('utf-8')
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def convert_df_parquet(key, _df):
+    # keeps the timezone aware index and dtypes, and is far smaller than csv
+    return frame_to_bytes(_df, 'parquet')
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def st_plot_met(key, _df):
+    return plot_met(_df)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def st_plot_historic_heat_fluxes(key, _energy_df):
+    return plot_historic_heat_fluxes(_energy_df)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def st_daily_sums(key, _energy_df):
+    # summed once per energy frame, every summary period is built from the daily sums
+    return daily_sums(_energy_df)
 
 
 st.set_page_config(layout="wide")
 
+# stage timings of every step run in this session, shown at the bottom of the page
+if 'timings' not in st.session_state:
+    st.session_state['timings'] = timing.Recorder()
+
+
+def recording():
+    return timing.recording(st.session_state['timings'])
+
+
 st.title('Historic Heat Flux Calculation Tool')
 
 with st.expander("1 Download Met Data From Iowa State Mesonet", expanded=True):
@@ -35,46 +105,73 @@ with st.expander("1 Download Met Data From Iowa State Mesonet", expanded=True):
     startts = st.text_input(r'Enter start date in the format YYYYMMDD:', '20230101')
     endts = st.text_input(r'Enter end date in the format YYYYMMDD:', '20230201')
     if st.button('Find data!'):
-        data = get_metar(station, startts, endts)
-        st.write('Data found for the station and period defined. Click Download button to save locally to CSV.')
-
-        st.download_button(
-            "Press to Download",
-            data,
-            f'{station}_{startts}0000_{endts}0000.csv',
-            "text/csv",
-            key='download-csv'
-        )
+        previous = st.session_state.get('download_job')
+        if previous is not None:
+            previous.cancel()
+        st.session_state['download_job'] = start_download(station, startts, endts)
+    # the download runs in the background, its progress is shown here by the
+    # loop at the end of the page, so the other sections are usable meanwhile
+    download_status = st.empty()
+    download_cancel = st.empty()
+    download_result = st.empty()
+    job = st.session_state.get('download_job')
+    if job is not None and not job.done and download_cancel.button('Cancel download'):
+        job.cancel()
 
 with st.expander("2 Upload Met Data to process", expanded=True):
     uploaded_file = st.file_uploader("Choose a file")
     if uploaded_file is not None:
-        st.session_state['raw_df'] = pd.read_csv(uploaded_file, skiprows=5, na_values=['M'])
+        raw_key = file_key(uploaded_file)
+        if st.session_state.get('raw_key') != raw_key:
+            with recording():
+                st.session_state['raw_df'] = read_metar_csv(uploaded_file)
+            st.session_state['raw_key'] = raw_key
         # st.write(dataframe)
 
 with st.expander("3 Process Met Data into Heat Flux Model inputs", expanded=True):
+    regularize = st.checkbox('Quality control and resample to an hourly grid (drops duplicates and bad values, '
+                             'interpolates gaps of up to 2 hours)')
+    grid = '1h' if regularize else None
     if st.button('Process!'):
-        st.session_state['df'] = st_make_metar_dataframe(st.session_state.raw_df)
+        with recording():
+            st.session_state['df'] = st_make_metar_dataframe(st.session_state.raw_key, grid, st.session_state.raw_df)
+        st.session_state['met_key'] = (st.session_state.raw_key, grid)
+        if grid:
+            st.write(st.session_state['df'].attrs['qc'])
         st.write(st.session_state['df'])
 
-        met_data = convert_df(st.session_state['df'])
+        met_data = convert_df(st.session_state.met_key, st.session_state['df'])
 
         st.download_button(
             "Press to Download",
             met_data,
             "met_data.csv",
             "text/csv",
-            key='download-csv'
+            key='download-met-csv'
         )    
+        st.download_button(
+            "Press to Download as Parquet",
+            convert_df_parquet(st.session_state.met_key, st.session_state['df']),
+            "met_data.parquet",
+            "application/octet-stream",
+            key='download-met-parquet'
+        )
 
 with st.expander("NEW Plot Met Data", expanded=True):
     if st.button('Plot!'):
-           fig = plot_met(st.session_state['df'])
+           with recording():
+               fig = st_plot_met(st.session_state.met_key, st.session_state['df'])
            st.write(fig)
 
 
 with st.expander("4 Calculate Heat Fluxes", expanded=False):
     T_water_C = st.number_input('Average Water Temperature (C)', value=3)
+    water_key = T_water_C
+    water_temperature_file = st.file_uploader('Optional water temperature record, replaces the average '
+                                              '(CSV with UTC time and temperature (C) columns)')
+    if water_temperature_file is not None:
+        T_water_C = read_water_temperature_csv(water_temperature_file)
+        water_key = file_key(water_temperature_file)
     st.write('Enter lat/lon location to calculate elevation and solar input. Location will default to airport location.')
     if 'df' in st.session_state.keys():
         airport_lat, airport_lon = return_lat_lon(st.session_state['df'])
@@ -91,23 +188,76 @@ with st.expander("4 Calculate Heat Fluxes", expanded=False):
     documentation_url = 'https://github.com/ski907/historicHeatFlux/blob/master/heatflux%20documentation.pdf'
     st.write("More info on heatflux calculations [here](%s)" % documentation_url)
     if st.button('Calculate Heat Fluxes'):
-        q_sw, q_atm, q_b, q_l, q_h, q_net = calc_fluxes(st.session_state['df'], T_water_C, lat, lon, a, b, c, R)
-        st.session_state['energy_df'] = build_energy_df(q_sw, q_atm, q_b, q_l, q_h)
+        energy_key = (st.session_state.met_key, water_key, lat, lon, a, b, c, R)
+        with recording():
+            st.session_state['energy_df'] = st_calc_energy(*energy_key, st.session_state['df'], T_water_C)
+        st.session_state['energy_key'] = energy_key
         st.write(st.session_state['energy_df'])
 
-        csv = convert_df(st.session_state['energy_df'])
+        csv = convert_df(energy_key, st.session_state['energy_df'])
 
         st.download_button(
             "Press to Download",
             csv,
             "file.csv",
             "text/csv",
-            key='download-csv'
+            key='download-energy-csv'
+        )
+        st.download_button(
+            "Press to Download as Parquet",
+            convert_df_parquet(st.session_state.energy_key, st.session_state['energy_df']),
+            "energy_flux.parquet",
+            "application/octet-stream",
+            key='download-energy-parquet'
         )
 
 with st.expander("5 Plot Results", expanded=True):
-    st.write('This may take a very long time if the data is more than a 60 days long. We recommend downloading the '
-             'output file and plotting externally for longer datasets.')
+    st.write('Long records are plotted as the minimum and maximum of each time bucket. Download the output file '
+             'for the full resolution data.')
     if st.button('Plot Results'):
-        fig = plot_historic_heat_fluxes(st.session_state.energy_df)
+        with recording():
+            fig = st_plot_historic_heat_fluxes(st.session_state.energy_key, st.session_state.energy_df)
         st.write(fig)
+
+with st.expander("6 Summaries", expanded=False):
+    st.write('Time-weighted mean fluxes (W/m^2) and totals (MJ/m^2) per period. Winters run October to April.')
+    period = st.selectbox('Period', ['month', 'winter', 'day', 'year'])
+    rolling_days = st.number_input('Rolling net flux window (days)', value=7, min_value=1)
+    if st.button('Summarize') and 'energy_df' in st.session_state:
+        with recording():
+            sums = st_daily_sums(st.session_state.energy_key, st.session_state.energy_df)
+            summary = summarize(sums=sums, freq=period)
+            rolling = rolling_net_flux(sums=sums, days=int(rolling_days))
+        st.write(summary)
+        st.download_button(
+            "Press to Download",
+            summary.to_csv().encode('utf-8'),
+            f"flux_summary_{period}.csv",
+            "text/csv",
+            key='download-summary'
+        )
+        st.line_chart(rolling.iloc[:, 0])
+
+with st.expander("Timings", expanded=False):
+    # wall time, rows and bytes per pipeline stage of the steps run so far
+    st.text(st.session_state['timings'].summary())
+    st.json(st.session_state['timings'].to_dict(), expanded=False)
+
+job = st.session_state.get('download_job')
+if job is not None:
+    while not job.done:
+        download_status.write(job.progress()[1])
+        time.sleep(0.5)
+    download_cancel.empty()
+    download_status.write(job.progress()[1])
+    if 'data' in job.results:
+        with download_result.container():
+            st.write('Data found for the station and period defined. Click Download button to save locally to CSV.')
+
+            st.download_button(
+                "Press to Download",
+                job.results['data'],
+                f'{job.key[1]}_{job.key[2]}0000_{job.key[3]}0000.csv',
+                "text/csv",
+                key='download-raw-csv'
+            )
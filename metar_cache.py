@@ -0,0 +1,279 @@
+"""
+On-disk cache of raw IEM ASOS downloads, one gzipped CSV file per station-day.
+
+get_metar consults the cache first, downloads only the days it does not have
+(merged into as few contiguous requests as possible) and reassembles the
+result into the same text layout the IEM service returns, so callers that
+parse it with skiprows=5 keep working.
+"""
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+
+# everything the package keeps between runs lives under CACHE_ROOT
+CACHE_ROOT = os.environ.get(
+    'HEATFLUX_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'historicHeatFlux'))
+CACHE_DIR = os.path.join(CACHE_ROOT, 'metar')
+# total size of the cache directory before the least recently used days are evicted
+MAX_CACHE_BYTES = 500 * 1024 ** 2
+# eviction trims the cache to this fraction of MAX_CACHE_BYTES, so the writes
+# that follow don't evict again at once
+EVICT_TO = 0.9
+# a day is only considered final once it was downloaded this long after it ended,
+# late and corrected reports keep trickling in for a while
+FINAL_AFTER = datetime.timedelta(hours=3)
+# days that are not final yet (e.g. today) are refreshed when older than this
+REFRESH_AFTER = datetime.timedelta(minutes=15)
+
+# running size of each cache directory as seen by this process, see track_write
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+# the IEM service starts its response with five debug lines, the apps skip them
+PREAMBLE = (
+    "#DEBUG: Format Typ    -> comma\n"
+    "#DEBUG: Time Period   -> %s %s\n"
+    "#DEBUG: Time Zone     -> Etc/UTC\n"
+    "#DEBUG: Data Contact   -> daryl herzmann akrherz@iastate.edu 515-294-5978\n"
+    "#DEBUG: Entries Found -> -1\n"
+)
+
+
+def load_table(name):
+    """Load a small JSON lookup table kept under CACHE_ROOT, {} if there is none yet"""
+    try:
+        with open(os.path.join(CACHE_ROOT, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def temp_path(path):
+    # unique per process and thread, so concurrent writers of the same file never share one
+    return '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+
+
+def save_table(name, table):
+    """Atomically write a JSON lookup table under CACHE_ROOT"""
+    path = os.path.join(CACHE_ROOT, name)
+    os.makedirs(CACHE_ROOT, exist_ok=True)
+    tmp = temp_path(path)
+    with open(tmp, 'w') as f:
+        json.dump(table, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def day_path(station, day):
+    return os.path.join(CACHE_DIR, station.upper(), day.strftime('%Y%m%d') + '.csv.gz')
+
+
+def split_by_day(data):
+    """Split a raw IEM response into its CSV header and the data lines of each UTC day.
+    Returns:
+      (header, {datetime.date: [lines]}); header is None if the response has no data
+    """
+    lines = [line for line in data.splitlines() if line and not line.startswith('#')]
+    if not lines:
+        return None, {}
+    header = lines[0]
+    valid_col = header.split(',').index('valid')
+    rows_by_day = {}
+    for line in lines[1:]:
+        # valid looks like 2023-01-01 00:15
+        day = datetime.date.fromisoformat(line.split(',', valid_col + 1)[valid_col][:10])
+        rows_by_day.setdefault(day, []).append(line)
+    return header, rows_by_day
+
+
+def is_final(day, written):
+    day_end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+    return written >= day_end + FINAL_AFTER
+
+
+def load_day(station, day, now=None):
+    """Return (header, lines) for a cached day, or None if it is missing or due for a refresh"""
+    path = day_path(station, day)
+    try:
+        mtime = os.path.getmtime(path)
+        written = datetime.datetime.utcfromtimestamp(mtime)
+        now = now or datetime.datetime.utcnow()
+        if not is_final(day, written) and now - written > REFRESH_AFTER:
+            return None
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        # mark as recently used for eviction, keeping the write time for the refresh rule
+        os.utime(path, (time.time(), mtime))
+    except FileNotFoundError:
+        # missing, or evicted by another process while we read it
+        return None
+    return lines[0], lines[1:]
+
+
+def store_day(station, day, header, lines):
+    path = day_path(station, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = temp_path(path)
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        f.write('\n'.join([header] + lines) + '\n')
+    os.replace(tmp, path)
+    track_write(path)
+
+
+def cache_files(directory):
+    # (last access, size, path) of every file under directory
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # another process evicted or replaced it meanwhile
+                continue
+            files.append((st.st_atime, st.st_size, path))
+    return files
+
+
+def evict(max_bytes=None, directory=None):
+    """Delete the least recently used files under directory (the day cache by
+    default) until it fits in max_bytes. Returns the size left."""
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    directory = directory or CACHE_DIR
+    files = cache_files(directory)
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    with _sizes_lock:
+        _sizes[directory] = total
+    return total
+
+
+def track_write(path, max_bytes=None, directory=None):
+    """Count a file just written under directory towards the running size of
+    the directory, evicting once it may be over max_bytes. The directory is
+    only walked on the first write of a process and when it is evicted, which
+    trims it to EVICT_TO of max_bytes so the next writes don't walk it again."""
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    directory = directory or CACHE_DIR
+    with _sizes_lock:
+        known = directory in _sizes
+    if not known:
+        total = sum(size for _, size, _ in cache_files(directory))
+        with _sizes_lock:
+            _sizes.setdefault(directory, total)
+    else:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        with _sizes_lock:
+            # other processes write too, the estimate is corrected whenever we evict
+            _sizes[directory] += size
+    with _sizes_lock:
+        over = _sizes[directory] > max_bytes
+    if over:
+        evict(int(max_bytes * EVICT_TO), directory)
+
+
+def contiguous_ranges(days):
+    """Group sorted dates into (first, last) runs of consecutive days"""
+    ranges = []
+    for day in sorted(days):
+        if ranges and day - ranges[-1][1] == datetime.timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(r) for r in ranges]
+
+
+def as_date(ts):
+    return ts.date() if isinstance(ts, datetime.datetime) else ts
+
+
+def failed_message(station, failed):
+    return 'could not download %s for %s' % (
+        station, ', '.join('%s to %s' % (as_date(start), as_date(end)) for start, end in failed))
+
+
+def _fill(station, days, fetch, cached):
+    # download the given days in contiguous runs and store every day, including
+    # empty ones, except those in ranges the fetch reports as failed
+    header = None
+    failed = []
+    for first, last in contiguous_ranges(days):
+        data, run_failed = fetch(station, first, last + datetime.timedelta(days=1))
+        failed.extend(run_failed)
+        run_header, rows_by_day = split_by_day(data)
+        if run_header is None:
+            # nothing usable came back, don't cache anything for this run
+            continue
+        header = run_header
+        day = first
+        while day <= last:
+            if not any(as_date(start) <= day < as_date(end) for start, end in run_failed):
+                lines = rows_by_day.get(day, [])
+                store_day(station, day, header, lines)
+                cached[day] = (header, lines)
+            day += datetime.timedelta(days=1)
+    return header, failed
+
+
+def get_cached_metar(station, startts, endts, fetch):
+    """Fetch [startts, endts) for a station through the day cache.
+    Args:
+      station (string): station identifier
+      startts, endts (datetime): UTC dates, endts is exclusive like the IEM service
+      fetch (callable): fetch(station, startts, endts) returning the raw IEM text
+        and a list of the [start, end) ranges it could not download
+    Returns:
+      string data in the IEM response layout, or "" if the station has no data
+    Raises:
+      IOError if part of the period could not be downloaded, the days that
+      were downloaded are cached so a retry only asks for the rest
+    """
+    days = []
+    day = as_date(startts)
+    end = as_date(endts)
+    while day < end:
+        days.append(day)
+        day += datetime.timedelta(days=1)
+
+    cached = {}
+    for day in days:
+        entry = load_day(station, day)
+        if entry is not None:
+            cached[day] = entry
+
+    missing = [day for day in days if day not in cached]
+    header, failed = _fill(station, missing, fetch, cached) if missing else (None, [])
+    if header is None and cached:
+        header = cached[max(cached)][0]
+    if header is None:
+        if failed:
+            raise IOError(failed_message(station, failed))
+        return ""
+
+    # IEM occasionally adds columns, refetch days that were cached with an older layout
+    stale = [day for day, (day_header, _) in cached.items() if day_header != header]
+    if stale:
+        failed.extend(_fill(station, stale, fetch, cached)[1])
+        cached = {day: entry for day, entry in cached.items() if entry[0] == header}
+
+    if failed:
+        raise IOError(failed_message(station, failed))
+
+    out = [PREAMBLE % (startts.strftime('%Y-%m-%d'), endts.strftime('%Y-%m-%d')), header + '\n']
+    for day in days:
+        if day in cached:
+            out.extend(line + '\n' for line in cached[day][1])
+    return ''.join(out)
@@ -0,0 +1,127 @@
+"""
+Quality control and time-grid regularization of decoded met frames.
+
+Runs between make_metar_dataframe and calc_fluxes:
+
+* duplicate timestamps are dropped, keeping the first report as plot_met does
+* values outside QC_LIMITS, and dewpoints above the air temperature, become NaN
+* every column is interpolated onto a regular grid (hourly by default), but only
+  across gaps of at most max_gap between the neighbouring valid reports;
+  wind direction takes the nearest report instead
+* grid times still missing a flux input are flagged in a boolean 'gap' column
+
+The result has one row per grid time, so flux inputs have a fixed, predictable
+size and the clear-sky lookup runs on a regular grid. Counts of what was
+dropped are kept in df.attrs['qc'].
+
+    df = clean_met(make_metar_dataframe(iter_metar_chunks('OGA', '20230101', '20230201')))
+"""
+import numpy as np
+import pandas as pd
+
+import timing
+from utils import index_ns
+
+# plausible ranges, anything outside is treated as a bad report
+QC_LIMITS = {
+    'air_temperature_C': (-65, 60),
+    'dewpoint_C': (-80, 40),
+    'humidity_%RH': (0, 100),
+    'atmospheric_pressure_mb': (850, 1090),
+    'wind_speed_ms': (0, 80),
+    'wind_direction_deg_from_N': (0, 360),
+    'cloudiness': (0, 1),
+}
+# unit twins of the checked columns, cleared along with them
+TWIN_COLUMNS = {'air_temperature_C': 'air_temperature_F', 'dewpoint_C': 'dewpoint_F',
+                'atmospheric_pressure_mb': 'atmospheric_pressure_inHg'}
+# columns calc_fluxes needs, a grid time missing any of them is a gap
+FLUX_INPUTS = ['cloudiness', 'air_temperature_C', 'dewpoint_C', 'wind_speed_ms', 'atmospheric_pressure_mb']
+NEAREST_COLUMNS = ['wind_direction_deg_from_N']
+GRID_FREQ = '1h'
+MAX_GAP = pd.Timedelta('2h')
+
+
+def qc_met(df):
+    """Sorted, deduplicated copy of a met frame with out of range values set to NaN,
+    and a report of what was removed"""
+    report = {'observations': len(df)}
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
+    duplicated = df.index.duplicated(keep='first')
+    report['duplicates'] = int(duplicated.sum())
+    df = df[~duplicated].copy()
+
+    out_of_range = {}
+    for column, (low, high) in QC_LIMITS.items():
+        if column not in df:
+            continue
+        values = df[column].to_numpy()
+        bad = (values < low) | (values > high)
+        if column == 'dewpoint_C' and 'air_temperature_C' in df:
+            # a little slack for rounding of the reported whole degrees F
+            bad |= values > df['air_temperature_C'].to_numpy() + 0.5
+        out_of_range[column] = int(bad.sum())
+        if bad.any():
+            for name in (column, TWIN_COLUMNS.get(column)):
+                if name in df:
+                    df.loc[bad, name] = np.nan
+    report['out_of_range'] = out_of_range
+    return df, report
+
+
+def grid_values(t, values, grid, max_gap, nearest=False):
+    # values at the grid times from the valid (t, values), NaN where the
+    # reports either side of a grid time are more than max_gap apart
+    valid = ~np.isnan(values)
+    t, values = t[valid], values[valid]
+    out = np.full(len(grid), np.nan)
+    if not len(t):
+        return out
+    right = np.searchsorted(t, grid, side='left')
+    inside = (right < len(t)) & (right > 0)
+    exact = (right < len(t)) & (t[np.minimum(right, len(t) - 1)] == grid)
+    r, l = np.minimum(right, len(t) - 1), np.maximum(right - 1, 0)
+    ok = exact | (inside & (t[r] - t[l] <= max_gap))
+    if nearest:
+        pick = np.where(exact, r, np.where(grid - t[l] <= t[r] - grid, l, r))
+        out[ok] = values[pick[ok]]
+    else:
+        out[ok] = np.interp(grid[ok], t, values)
+    return out
+
+
+@timing.timed('regularize')
+def regularize_met(df, freq=GRID_FREQ, max_gap=MAX_GAP):
+    """Interpolate a deduplicated, sorted met frame onto a regular grid of freq,
+    bridging at most max_gap between reports, and add the 'gap' flag column"""
+    if df.empty:
+        return df.assign(gap=pd.Series(dtype=bool))
+    grid = pd.date_range(df.index.min().ceil(freq), df.index.max().floor(freq), freq=freq, name=df.index.name)
+    t = index_ns(df.index)
+    g = index_ns(grid)
+    gap_ns = pd.Timedelta(max_gap).value
+
+    columns = {}
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype.kind != 'f':
+            continue
+        if column in ('lat', 'lon'):
+            columns[column] = np.full(len(grid), values[0])
+            continue
+        columns[column] = grid_values(t, values.astype(np.float64), g, gap_ns,
+                                      nearest=column in NEAREST_COLUMNS).astype(values.dtype)
+    out = pd.DataFrame(columns, index=grid)
+    inputs = [c for c in FLUX_INPUTS if c in out]
+    out['gap'] = out[inputs].isna().any(axis=1).to_numpy() if inputs else False
+    return out
+
+
+def clean_met(df, freq=GRID_FREQ, max_gap=MAX_GAP):
+    """qc_met then regularize_met, the counts are kept in attrs['qc']"""
+    df, report = qc_met(df)
+    out = regularize_met(df, freq, max_gap)
+    report.update({'grid': str(freq), 'grid_points': len(out), 'gaps': int(out['gap'].sum())})
+    out.attrs['qc'] = report
+    return out
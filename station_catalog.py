@@ -0,0 +1,173 @@
+"""
+Offline ASOS station catalog and fluxes at sites without an airport.
+
+The catalog is a CSV with station, name, lat, lon and elevation (m) columns,
+the same layout elevation.py reads as its station table, so pointing
+HEATFLUX_STATION_TABLE at it also answers elevation lookups for every
+station without the API. download_catalog builds it once from the IEM
+network listings.
+
+StationCatalog keeps the stations in a KD-tree of unit vectors on the
+sphere, so nearest-station queries cost microseconds and distances are great
+circle distances.
+
+site_fluxes decodes the nearest stations to a lat/lon and site_met bins them
+onto a shared time grid and inverse-distance-weights each met field, giving
+a met frame calc_fluxes can use as if it came from a station at the site:
+
+    catalog = StationCatalog.load()
+    catalog.nearest(44.95, -93.10, k=4)
+    met_df, energy_df = site_fluxes(44.95, -93.10, '20230101', '20230201', catalog=catalog)
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import iowa_metar_scrape as ia
+import metar_cache
+import timing
+from elevation import STATION_TABLE
+from ice_stats import station_block
+from utils import iter_metar_chunks, make_metar_dataframe, calc_energy_df
+
+CATALOG_PATH = STATION_TABLE or os.path.join(metar_cache.CACHE_ROOT, 'stations.csv')
+NETWORK_URL = 'https://mesonet.agron.iastate.edu/geojson/network/{network}.geojson'
+US_STATES = ['AK', 'AL', 'AR', 'AZ', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'HI', 'IA', 'ID', 'IL', 'IN', 'KS', 'KY',
+             'LA', 'MA', 'MD', 'ME', 'MI', 'MN', 'MO', 'MS', 'MT', 'NC', 'ND', 'NE', 'NH', 'NJ', 'NM', 'NV', 'NY',
+             'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VA', 'VT', 'WA', 'WI', 'WV', 'WY']
+EARTH_RADIUS_KM = 6371.0
+
+# met fields interpolated between stations, the ones calc_fluxes and plot_met use
+SITE_COLUMNS = ['atmospheric_pressure_mb', 'air_temperature_C', 'dewpoint_C', 'humidity_%RH', 'wind_speed_ms',
+                'cloudiness']
+SITE_FREQ = '1h'
+# stations used for a site, how far away they may be, and the IDW exponent
+SITE_STATIONS = 4
+SITE_MAX_KM = 150.0
+IDW_POWER = 2
+
+
+def download_catalog(path=CATALOG_PATH, networks=None):
+    """Build the catalog CSV from the IEM listings of the given networks,
+    by default the ASOS network of every US state. Returns the table."""
+    rows = []
+    for network in networks or ['%s_ASOS' % state for state in US_STATES]:
+        data = ia.download_data(NETWORK_URL.format(network=network))
+        if not data:
+            continue
+        for feature in json.loads(data).get('features', []):
+            props = feature['properties']
+            lon, lat = feature['geometry']['coordinates'][:2]
+            rows.append({'station': props.get('sid', feature.get('id')), 'name': props.get('sname', ''),
+                         'lat': lat, 'lon': lon, 'elevation': props.get('elevation', '')})
+    table = pd.DataFrame(rows, columns=['station', 'name', 'lat', 'lon', 'elevation'])
+    table = table.drop_duplicates('station').sort_values('station')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    table.to_csv(path + '.part', index=False)
+    os.replace(path + '.part', path)
+    return table
+
+
+def unit_vectors(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+class StationCatalog(object):
+    def __init__(self, table):
+        self.table = table.reset_index(drop=True)
+        self.tree = cKDTree(unit_vectors(self.table['lat'].to_numpy(), self.table['lon'].to_numpy()))
+
+    @classmethod
+    def load(cls, path=CATALOG_PATH):
+        """Read the catalog CSV written by download_catalog"""
+        if not os.path.exists(path):
+            raise IOError('No station catalog at %s, build one with download_catalog()' % path)
+        return cls(pd.read_csv(path, dtype={'station': str, 'name': str}))
+
+    def query(self, lat, lon, k=SITE_STATIONS, max_km=None):
+        """Great circle distances (km) and catalog rows of the k nearest stations,
+        nearest first, leaving out those further than max_km"""
+        k = min(k, len(self.table))
+        bound = np.inf if max_km is None else 2 * np.sin(max_km / (2 * EARTH_RADIUS_KM))
+        chord, rows = self.tree.query(unit_vectors(lat, lon)[0], k=k, distance_upper_bound=bound)
+        chord, rows = np.atleast_1d(chord), np.atleast_1d(rows)
+        found = np.isfinite(chord)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord[found] / 2, 1)), rows[found]
+
+    def nearest(self, lat, lon, k=SITE_STATIONS, max_km=None):
+        """The k nearest stations as catalog rows with a distance_km column"""
+        distances, rows = self.query(lat, lon, k, max_km)
+        nearest = self.table.iloc[rows].copy()
+        nearest['distance_km'] = distances
+        return nearest
+
+
+def idw_weights(distances_km, power=IDW_POWER):
+    # a station (almost) at the site takes all the weight
+    return 1.0 / np.maximum(distances_km, 0.01) ** power
+
+
+@timing.timed('site_met')
+def site_met(met_frames, distances_km, lat, lon, freq=SITE_FREQ, power=IDW_POWER):
+    """
+    Inverse-distance-weighted met frame at (lat, lon) from the decoded frames
+    of nearby stations (in the order of distances_km), on a UTC grid of freq.
+    At each time only the stations reporting a field share its weight.
+    """
+    frames = {i: frame for i, frame in enumerate(met_frames)}
+    start = min(frame.index.min() for frame in met_frames).tz_convert('UTC').floor(freq)
+    end = max(frame.index.max() for frame in met_frames).tz_convert('UTC')
+    times = pd.date_range(start, end, freq=freq, name='date')
+
+    w = idw_weights(np.asarray(distances_km, dtype=np.float64), power)[:, None]
+    columns = {'lat': np.full(len(times), lat), 'lon': np.full(len(times), lon)}
+    for column in SITE_COLUMNS:
+        values = station_block(frames, column, freq, max_fill=0, times=times)[2]
+        reporting = ~np.isnan(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns[column] = ((np.where(reporting, values, 0.0) * w).sum(axis=0)
+                               / (reporting * w).sum(axis=0)).astype(np.float32)
+    return pd.DataFrame(columns, index=times)
+
+
+def site_fluxes(lat, lon, startts, endts, catalog=None, k=SITE_STATIONS, max_km=SITE_MAX_KM, T_water_C=2.0,
+                a=10 ** -6, b=10 ** -6, c=1, R=1, elevation=None, freq=SITE_FREQ, power=IDW_POWER):
+    """
+    Met and energy frames at an arbitrary location, interpolated from the k
+    nearest catalog stations within max_km. The site elevation defaults to
+    the IDW of the station elevations, so no elevation lookup is needed.
+    startts and endts are YYYYMMDD like get_metar. Returns (met_df, energy_df).
+    """
+    catalog = catalog or StationCatalog.load()
+    nearest = catalog.nearest(lat, lon, k, max_km)
+    if nearest.empty:
+        raise ValueError('No catalog station within %g km of %s, %s' % (max_km, lat, lon))
+
+    def decode(station):
+        return make_metar_dataframe(iter_metar_chunks(station, startts, endts))
+
+    # the downloads share the IEM rate limiter, decoding overlaps with them
+    with ThreadPoolExecutor(max_workers=min(len(nearest), ia.HOST_CONCURRENCY)) as pool:
+        frames = [job.result() for job in [timing.submit(pool, decode, station) for station in nearest['station']]]
+    keep = [i for i, frame in enumerate(frames) if len(frame)]
+    if not keep:
+        raise ValueError('None of %s reported between %s and %s' % (', '.join(nearest['station']), startts, endts))
+    nearest = nearest.iloc[keep]
+    frames = [frames[i] for i in keep]
+
+    distances = nearest['distance_km'].to_numpy()
+    met_df = site_met(frames, distances, lat, lon, freq, power)
+    if elevation is None:
+        elevations = nearest['elevation'].to_numpy(dtype=np.float64)
+        ok = ~np.isnan(elevations)
+        if not ok.any():
+            raise ValueError('No elevations in the catalog for %s, pass elevation' % ', '.join(nearest['station']))
+        w = idw_weights(distances[ok], power)
+        elevation = float((elevations[ok] * w).sum() / w.sum())
+    energy_df = calc_energy_df(met_df, T_water_C, lat, lon, a, b, c, R, elevation=elevation)
+    return met_df, energy_df
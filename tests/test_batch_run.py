@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+import batch_run
+import iowa_metar_scrape as ia
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    # stands in for download_to_file, months listed in fail come back as failed
+    requests = []
+    fail = set()
+
+    def download_to_file(uri, outfn):
+        requests.append(outfn)
+        if os.path.basename(outfn) in fail:
+            return None
+        with open(outfn, 'w') as f:
+            f.write('station,valid\n')
+        return True
+
+    monkeypatch.setattr(ia, 'download_to_file', download_to_file)
+    return requests, fail
+
+
+def test_download_station_keeps_months_for_a_retry(tmp_path, downloads):
+    requests, fail = downloads
+    fail.add('OGA_20230201_20230301.txt')
+    with pytest.raises(IOError, match='2023-02-01 to 2023-03-01'):
+        batch_run.download_station('OGA', '20230101', '20230315', str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ['OGA_20230101_20230201.txt', 'OGA_20230301_20230315.txt']
+
+    # only the failed month is requested again
+    fail.clear()
+    del requests[:]
+    files, _ = batch_run.download_station('OGA', '20230101', '20230315', str(tmp_path))
+    assert [os.path.basename(fn) for fn in requests] == ['OGA_20230201_20230301.txt']
+    assert [os.path.basename(fn) for fn in files] == [
+        'OGA_20230101_20230201.txt', 'OGA_20230201_20230301.txt', 'OGA_20230301_20230315.txt']
@@ -0,0 +1,17 @@
+import datetime
+
+import iowa_metar_scrape as ia
+
+
+def test_month_ranges_of_dates():
+    assert list(ia.month_ranges(datetime.date(2022, 12, 15), datetime.date(2023, 2, 10))) == [
+        (datetime.date(2022, 12, 15), datetime.date(2023, 1, 1)),
+        (datetime.date(2023, 1, 1), datetime.date(2023, 2, 1)),
+        (datetime.date(2023, 2, 1), datetime.date(2023, 2, 10))]
+
+
+def test_month_ranges_from_within_a_day():
+    start = datetime.datetime(2024, 1, 30, 11, 15)
+    assert list(ia.month_ranges(start, datetime.datetime(2024, 2, 2))) == [
+        (start, datetime.datetime(2024, 2, 1)),
+        (datetime.datetime(2024, 2, 1), datetime.datetime(2024, 2, 2))]
@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+import iowa_metar_scrape as ia
+import metar_cache
+import timing
+import utils
+
+HEADER = 'station,valid,lon,lat,tmpf,dwpf,relh,drct,sknt,alti,skyc1,skyc2,skyc3,skyc4'
+ROW = 'OGA,%s 00:15,-101.77,41.12,32.0,23.0,69.0,270.00,10.0,30.01,FEW,M,M,M'
+
+
+class Service(object):
+    # stands in for urlopen, answering each request with the next of the given bodies
+    def __init__(self, *bodies):
+        self.bodies = list(bodies)
+        self.requests = []
+
+    def __call__(self, uri, timeout=None):
+        self.requests.append(uri)
+        body = self.bodies.pop(0)
+        if isinstance(body, Exception):
+            raise body
+        return io.BytesIO(body.encode('utf-8'))
+
+
+@pytest.fixture
+def service(monkeypatch):
+    def install(*bodies):
+        service = Service(*bodies)
+        monkeypatch.setattr(ia, 'urlopen', service)
+        return service
+    monkeypatch.setattr(ia, 'backoff_delay', lambda attempt, retry_after=None: 0)
+    monkeypatch.setattr(ia.rate_limiter, 'acquire', lambda: None)
+    return install
+
+
+def month(day):
+    return metar_cache.PREAMBLE % ('x', 'y') + HEADER + '\n' + ROW % day + '\n'
+
+
+def decode(*args):
+    return utils.make_metar_dataframe(utils.iter_metar_chunks('OGA', *args, use_cache=False))
+
+
+def test_streamed_months_are_decoded(service):
+    service(month('2020-01-05'), month('2020-02-05'))
+    assert len(decode('20200101', '20200301')) == 2
+
+
+def test_error_body_is_retried(service):
+    requests = service('ERROR: too many requests\n', month('2020-01-05'), month('2020-02-05')).requests
+    assert len(decode('20200101', '20200301')) == 2
+    assert len(requests) == 3
+
+
+def test_month_out_of_attempts_raises(service, monkeypatch):
+    monkeypatch.setattr(ia, 'MAX_ATTEMPTS', 2)
+    service(month('2020-01-05'), 'ERROR: too many requests\n', OSError('reset'))
+    with pytest.raises(IOError, match='2020-02-01 to 2020-03-01'):
+        decode('20200101', '20200301')
+
+
+def test_download_counts_response_bytes(service):
+    body = month('2020-01-05')
+    service(body)
+    with timing.recording() as rec:
+        decode('20200101', '20200201')
+    download, = [record for record in rec.records if record['stage'] == 'download']
+    assert download['bytes'] == len(body.encode('utf-8'))
@@ -0,0 +1,60 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+import live
+
+
+def met(*times):
+    index = pd.DatetimeIndex(times, tz='UTC')
+    return pd.DataFrame({'lat': 41.12, 'lon': -101.77, 'tmpc': 0.0}, index=index)
+
+
+@pytest.fixture
+def station(monkeypatch, tmp_path):
+    # _fetch answers with the next of the given frames or exceptions and
+    # records what it was asked for; the fluxes are all zero
+    fetches = []
+    answers = []
+
+    def fetch(station, start, end):
+        fetches.append((start, end))
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def calc_fluxes(df, *args, **kwargs):
+        zero = pd.Series(0.0, index=df.index)
+        return (zero,) * 6
+
+    monkeypatch.setattr(live, 'LIVE_DIR', str(tmp_path))
+    monkeypatch.setattr(live, '_fetch', fetch)
+    monkeypatch.setattr(live, 'calc_fluxes', calc_fluxes)
+    monkeypatch.setattr(live, 'get_elevation', lambda lat, lon: 300.0)
+    return fetches, answers
+
+
+NOW = datetime.datetime(2024, 3, 10, 12, 30)
+
+
+def test_refresh_asks_from_the_last_observation(station):
+    fetches, answers = station
+    answers += [met('2024-03-09 10:15', '2024-03-10 11:15'), met('2024-03-10 11:15', '2024-03-10 11:35')]
+    assert live.update_live('OGA', now=NOW)[2] == 2
+    assert live.update_live('OGA', now=NOW)[2] == 1
+    assert fetches[0] == (datetime.datetime(2024, 2, 29), datetime.datetime(2024, 3, 11))
+    assert fetches[1] == (datetime.datetime(2024, 3, 10, 11, 15), datetime.datetime(2024, 3, 11))
+
+
+def test_failed_download_keeps_the_stored_state(station):
+    fetches, answers = station
+    answers += [met('2024-03-10 11:15'), IOError('could not download OGA'), met('2024-03-10 11:35')]
+    live.update_live('OGA', now=NOW)
+    with pytest.raises(IOError):
+        live.update_live('OGA', now=NOW)
+    # the next update asks for the same period again
+    _, energy_df, n_new = live.update_live('OGA', now=NOW)
+    assert fetches[1] == fetches[2]
+    assert n_new == 1 and len(energy_df) == 2
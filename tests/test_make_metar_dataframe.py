@@ -0,0 +1,48 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import metar_cache
+from utils import read_metar_chunks, make_metar_dataframe, make_metar_dataframe_local
+
+HEADER = ('station,valid,lon,lat,tmpf,dwpf,relh,drct,sknt,p01i,alti,mslp,vsby,gust,'
+          'skyc1,skyc2,skyc3,skyc4,skyl1,skyl2,skyl3,skyl4,wxcodes,metar')
+ROW = 'OGA,2023-01-01 00:15,-101.7700,41.1200,32.0,23.0,69.0,270.00,10.0,0.00,30.01,M,10.00,M,FEW,OVC,M,M,M,M,M,M,M,x'
+
+
+def response(*lines):
+    # an IEM download: the debug preamble, then the given lines
+    return metar_cache.PREAMBLE % ('2023-01-01', '2023-01-02') + ''.join(line + '\n' for line in lines)
+
+
+def decode(text):
+    return make_metar_dataframe(read_metar_chunks(io.StringIO(text)))
+
+
+@pytest.fixture
+def expected():
+    # columns and dtypes of a normal decode
+    return decode(response(HEADER, ROW))
+
+
+@pytest.mark.parametrize('text', ['', response(), response(HEADER)], ids=['empty', 'preamble only', 'header only'])
+def test_no_observations_decode_to_empty_frame(text, expected):
+    df = decode(text)
+    assert df.empty
+    assert list(df.columns) == list(expected.columns)
+    assert (df.dtypes == expected.dtypes).all()
+    assert isinstance(df.index, pd.DatetimeIndex)
+    assert str(df.index.tz) == 'Etc/UTC'
+
+
+def test_header_only_local_frame_is_empty():
+    assert make_metar_dataframe_local(read_metar_chunks(io.StringIO(response(HEADER)))).empty
+
+
+def test_one_observation(expected):
+    assert len(expected) == 1
+    assert expected['air_temperature_C'].iloc[0] == pytest.approx(0.0)
+    assert expected['cloudiness'].iloc[0] == pytest.approx(1.0)
+    assert expected['wind_speed_ms'].dtype == np.float32
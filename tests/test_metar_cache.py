@@ -0,0 +1,115 @@
+import datetime
+import os
+
+import pytest
+
+import metar_cache
+
+HEADER = 'station,valid,tmpf'
+D = datetime.date
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metar_cache, 'CACHE_DIR', str(tmp_path / 'metar'))
+    monkeypatch.setattr(metar_cache, '_sizes', {})
+    return tmp_path / 'metar'
+
+
+class Fetch(object):
+    # stands in for utils.download_metar: two reports a day, failing the given days
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = set(failing)
+
+    def __call__(self, station, start, end):
+        self.calls.append((start, end))
+        lines, failed = ['#DEBUG: x', HEADER], []
+        day = start
+        while day < end:
+            if day in self.failing:
+                failed.append((day, day + datetime.timedelta(days=1)))
+            else:
+                lines += ['%s,%s %s,50' % (station, day.isoformat(), hour) for hour in ('00:15', '12:15')]
+            day += datetime.timedelta(days=1)
+        return '\n'.join(lines) + '\n', failed
+
+
+def get(fetch, start, end):
+    return metar_cache.get_cached_metar('OGA', start, end, fetch)
+
+
+def rows(data):
+    return [line for line in data.splitlines() if line.startswith('OGA,')]
+
+
+def test_only_missing_days_are_fetched():
+    fetch = Fetch()
+    assert len(rows(get(fetch, D(2020, 1, 1), D(2020, 1, 4)))) == 6
+    data = get(fetch, D(2020, 1, 2), D(2020, 1, 7))
+    assert fetch.calls == [(D(2020, 1, 1), D(2020, 1, 4)), (D(2020, 1, 4), D(2020, 1, 7))]
+    assert len(rows(data)) == 10
+    assert data.splitlines()[5] == HEADER
+
+
+def test_recent_day_is_refreshed_final_day_is_not():
+    fetch = Fetch()
+    today = datetime.datetime.utcnow().date()
+    get(fetch, today - datetime.timedelta(days=3), today + datetime.timedelta(days=1))
+    later = datetime.datetime.utcnow() + metar_cache.REFRESH_AFTER + datetime.timedelta(minutes=1)
+    assert metar_cache.load_day('OGA', today, now=later) is None
+    assert metar_cache.load_day('OGA', today) is not None
+    # days 3 and 2 ago were written long after they ended
+    assert metar_cache.load_day('OGA', today - datetime.timedelta(days=3), now=later) is not None
+
+
+def test_failed_days_raise_and_are_not_cached():
+    fetch = Fetch(failing={D(2020, 1, 2)})
+    with pytest.raises(IOError, match='2020-01-02'):
+        get(fetch, D(2020, 1, 1), D(2020, 1, 4))
+    assert metar_cache.load_day('OGA', D(2020, 1, 1)) is not None
+    assert metar_cache.load_day('OGA', D(2020, 1, 2)) is None
+
+    fetch.failing.clear()
+    assert len(rows(get(fetch, D(2020, 1, 1), D(2020, 1, 4)))) == 6
+    assert fetch.calls[-1] == (D(2020, 1, 2), D(2020, 1, 3))
+
+
+def test_day_evicted_while_reading_is_a_miss(monkeypatch):
+    get(Fetch(), D(2020, 1, 1), D(2020, 1, 2))
+    path = metar_cache.day_path('OGA', D(2020, 1, 1))
+    real_open = metar_cache.gzip.open
+
+    def evicted(*args, **kwargs):
+        os.remove(path)
+        return real_open(*args, **kwargs)
+
+    monkeypatch.setattr(metar_cache.gzip, 'open', evicted)
+    assert metar_cache.load_day('OGA', D(2020, 1, 1)) is None
+
+
+def test_least_recently_used_days_are_evicted(cache_dir):
+    fetch = Fetch()
+    get(fetch, D(2020, 1, 1), D(2020, 1, 11))
+    paths = [metar_cache.day_path('OGA', D(2020, 1, n)) for n in range(1, 11)]
+    for n, path in enumerate(paths):
+        os.utime(path, (1000 + n, os.path.getmtime(path)))
+    size = os.path.getsize(paths[0])
+
+    left = metar_cache.evict(max_bytes=5 * size + size // 2)
+    assert left <= 5 * size + size // 2
+    assert [os.path.exists(p) for p in paths] == [False] * 5 + [True] * 5
+
+
+def test_writes_walk_the_cache_only_when_it_may_be_full(monkeypatch):
+    walks = []
+    real = metar_cache.cache_files
+    monkeypatch.setattr(metar_cache, 'cache_files', lambda d: walks.append(d) or real(d))
+    get(Fetch(), D(2020, 1, 1), D(2020, 3, 1))
+    assert len(walks) == 1
+
+    size = os.path.getsize(metar_cache.day_path('OGA', D(2020, 1, 1)))
+    monkeypatch.setattr(metar_cache, 'MAX_CACHE_BYTES', 70 * size)
+    get(Fetch(), D(2020, 3, 1), D(2020, 4, 1))
+    assert 1 < len(walks) < 5
+    assert len(metar_cache.cache_files(str(metar_cache.CACHE_DIR))) <= 70
@@ -0,0 +1,124 @@
+"""
+Optional timing of the pipeline's hot paths.
+
+Instrumented code opens a stage:
+
+    with stage('decode') as info:
+        ...
+        info['rows'] = len(df)
+
+which costs next to nothing unless a recorder is active. To see where time
+goes, wrap a run in recording():
+
+    with recording() as rec:
+        df = make_metar_dataframe(iter_metar_chunks('OGA', '20230101', '20230201'))
+    rec.print_summary()
+    rec.to_json()
+
+The active recorder is held in a context variable, so concurrent Streamlit
+sessions each see only their own stages. Stages may nest, e.g. the elevation
+and clear-sky lookups run inside calc_fluxes.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+
+_recorder = contextvars.ContextVar('heatflux_timing_recorder', default=None)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, rows=None, nbytes=None):
+        # counts often come from numpy or pandas, keep them json friendly
+        rows = None if rows is None else int(rows)
+        nbytes = None if nbytes is None else int(nbytes)
+        with self.lock:
+            self.records.append({'stage': name, 'seconds': seconds, 'rows': rows, 'bytes': nbytes})
+
+    def totals(self):
+        """Per stage totals in the order stages were first seen"""
+        totals = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            total = totals.setdefault(record['stage'], {'stage': record['stage'], 'calls': 0, 'seconds': 0.0,
+                                                        'rows': 0, 'bytes': 0})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['rows'] += record['rows'] or 0
+            total['bytes'] += record['bytes'] or 0
+        return list(totals.values())
+
+    def summary(self):
+        lines = ['%-18s %6s %10s %12s %12s' % ('stage', 'calls', 'seconds', 'rows', 'bytes')]
+        for total in self.totals():
+            lines.append('%-18s %6d %10.3f %12d %12d' % (total['stage'], total['calls'], total['seconds'],
+                                                         total['rows'], total['bytes']))
+        return '\n'.join(lines)
+
+    def print_summary(self):
+        print(self.summary())
+
+    def to_dict(self):
+        return {'totals': self.totals(), 'records': list(self.records)}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+@contextlib.contextmanager
+def recording(recorder=None):
+    """Collect the stages run in this context (and threads started with its context)"""
+    recorder = recorder or Recorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+def active():
+    return _recorder.get() is not None
+
+
+@contextlib.contextmanager
+def stage(name, rows=None, nbytes=None):
+    """Time a block, the yielded dict takes 'rows' and 'bytes' filled in by the block"""
+    recorder = _recorder.get()
+    info = {'rows': rows, 'bytes': nbytes}
+    if recorder is None:
+        yield info
+        return
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        recorder.add(name, time.perf_counter() - start, info['rows'], info['bytes'])
+
+
+def timed(name, count='result'):
+    """Decorator version of stage, rows are len() of the result, or of the first
+    argument with count='input', where that has a length"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as info:
+                result = func(*args, **kwargs)
+                try:
+                    info['rows'] = len(args[0] if count == 'input' else result)
+                except (TypeError, IndexError):
+                    pass
+                return result
+        return wrapper
+    return decorator
+
+
+def submit(pool, func, *args, **kwargs):
+    """pool.submit that carries the active recorder into the worker thread"""
+    return pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
@@ -1,126 +1,287 @@
 import iowa_metar_scrape as ia
+import metar_cache
+import timing
 import datetime
+import io
+import threading
+import warnings
+import numpy as np
 import pandas as pd
-import requests
+from elevation import get_elevation
+from clearsky import get_clearsky_ghi, index_ns
 from pvlib.location import Location
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from timezonefinder import TimezoneFinder
-import pytz
 
+# rows per DataFrame chunk when parsing IEM downloads incrementally
+METAR_CHUNKSIZE = 50000
 
-def get_metar(station, startts, endts):
+# the raw IEM columns make_metar_dataframe needs, everything else is skipped when reading
+SKY_COLUMNS = ['skyc1', 'skyc2', 'skyc3', 'skyc4']
+METAR_COLUMNS = ['valid', 'lat', 'lon', 'alti', 'tmpf', 'dwpf', 'relh', 'sknt', 'drct'] + SKY_COLUMNS
+METAR_DTYPES = dict({'valid': str, 'lat': 'float64', 'lon': 'float64'},
+                    **{name: 'float32' for name in ['alti', 'tmpf', 'dwpf', 'relh', 'sknt', 'drct']},
+                    **{name: 'category' for name in SKY_COLUMNS})
+# fraction of the sky covered for each METAR sky condition code
+CLOUD_COVER = {'CLR': 0, 'SKC': 0, 'FEW': 1.5 / 8, 'SCT': 3.5 / 8, 'BKN': 6 / 8, 'OVC': 8 / 8}
+
+# plots are downsampled to about two points per horizontal pixel of this width
+PLOT_WIDTH_PX = 1600
+# time bucket sizes of downsampled plots, from the finest
+PLOT_RESOLUTIONS = ['1min', '5min', '10min', '20min', '30min', '1h', '2h', '3h', '6h', '12h',
+                    '1D', '2D', '3D', '4D', '7D', '14D', '30D', '91D', '365D']
+# traces with more points than this are drawn with WebGL
+WEBGL_POINTS = 20000
+
+# water temperature readings further apart than this are not interpolated between
+WATER_MAX_GAP = pd.Timedelta('2D')
+
+# columns of the energy frame, the last is the sum of the others
+ENERGY_COLUMNS = ['downwelling SW', 'downwelling LW', 'upwelling LW', 'sensible heat', 'latent heat', 'net flux']
+
+# station coordinates -> timezone name, persisted so each station is only looked up once
+TIMEZONE_CACHE = 'timezones.json'
+_timezone_finder = None
+_timezones = None
+_timezones_lock = threading.Lock()
+
+
+def download_metar(station, startts, endts):
     ###This is a slightly modified version of an example from the Iowa State Mesonet page
     # https://mesonet.agron.iastate.edu/request/download.phtml?network=NE_ASOS
     # https://github.com/akrherz/iem/blob/main/scripts/asos/iem_scraper_example.py
 
+    # startts and endts are dates or datetimes in UTC, endts is exclusive
+    # long periods are requested a month at a time and stitched back together
+    # returns (data, failed) with failed the [start, end) months that could not
+    # be downloaded, they are missing from data
+    print("Downloading: %s" % (station,))
+    pieces = []
+    failed = []
+    for start, end in ia.month_ranges(startts, endts):
+        data = ia.download_data(ia.build_uri(station, start, end))
+        if not data:
+            # every attempt failed
+            failed.append((start, end))
+        pieces.append(data)
+
+    return merge_metar(pieces), failed
+
+
+def merge_metar(pieces):
+    # join consecutive IEM responses into one, keeping the preamble and header
+    # of the first non-empty piece only
+    out = []
+    for data in pieces:
+        if not data:
+            continue
+        if out:
+            data = ''.join(line for line in data.splitlines(True)
+                           if not line.startswith('#') and not line.startswith('station,'))
+        out.append(data)
+    return ''.join(out)
+
+
+def get_metar(station, startts, endts, use_cache=True):
     # expects dates like 19990201 for 2 Feb 1999
     startts = datetime.datetime.strptime(startts, '%Y%m%d')
     endts = datetime.datetime.strptime(endts, '%Y%m%d')
 
-    service = ia.SERVICE + "data=all&tz=Etc/UTC&format=comma&latlon=yes&"
-
-    service += startts.strftime("year1=%Y&month1=%m&day1=%d&")
-    service += endts.strftime("year2=%Y&month2=%m&day2=%d&")
+    if not use_cache:
+        data, failed = download_metar(station, startts, endts)
+        if failed:
+            raise IOError(metar_cache.failed_message(station, failed))
+        return data
+
+    # only the days missing from the local cache are downloaded
+    return metar_cache.get_cached_metar(station, startts, endts, download_metar)
+
+
+def read_metar_chunks(f, chunksize=METAR_CHUNKSIZE):
+    # parse IEM csv text from a file-like object into DataFrame chunks without
+    # reading it all first, the '#DEBUG' preamble is skipped whatever its length;
+    # an IEM error message (e.g. when throttled) raises RetryableError
+    line = f.readline()
+    while line.startswith('#'):
+        line = f.readline()
+    if line.startswith('ERROR'):
+        raise ia.RetryableError(line.strip())
+    if not line.strip():
+        return []
+    names = line.strip().split(',')
+    return pd.read_csv(f, names=names, header=None, usecols=METAR_COLUMNS, dtype=METAR_DTYPES,
+                       na_values=['M'], chunksize=chunksize)
+
+
+@timing.timed('read_csv')
+def read_metar_csv(f):
+    # read a downloaded IEM file, loading only the columns the decoder uses
+    return pd.read_csv(f, skiprows=5, usecols=METAR_COLUMNS, dtype=METAR_DTYPES, na_values=['M'])
+
+
+def iter_metar_chunks(station, startts, endts, chunksize=METAR_CHUNKSIZE, use_cache=True):
+    # same period as get_metar, but fetched a month at a time and yielded as raw
+    # DataFrame chunks that make_metar_dataframe can consume directly. startts
+    # and endts may also be UTC datetimes, the uncached path then only asks for
+    # what lies between them, the cache works in whole days
+    if not isinstance(startts, datetime.datetime):
+        startts = datetime.datetime.strptime(startts, '%Y%m%d')
+    if not isinstance(endts, datetime.datetime):
+        endts = datetime.datetime.strptime(endts, '%Y%m%d')
+
+    def consume(response):
+        # the download stage counts the bytes that came off the socket, not
+        # the size of the parsed frames
+        counter = _CountingReader(response)
+        chunks = list(read_metar_chunks(io.TextIOWrapper(io.BufferedReader(counter), encoding='utf-8'), chunksize))
+        return chunks, counter.nbytes
 
-    uri = "%s&station=%s" % (service, station)
     print("Downloading: %s" % (station,))
-    data = ia.download_data(uri)
+    for start, end in ia.month_ranges(startts, endts):
+        if use_cache:
+            data = metar_cache.get_cached_metar(station, start, end, download_metar)
+            chunks = read_metar_chunks(io.StringIO(data), chunksize)
+        else:
+            # the response is parsed as it comes off the socket, only the parsed
+            # month is held in memory
+            chunks = ia.fetch_with_retry(ia.build_uri(station, start, end), consume)
+            if chunks is None:
+                raise IOError(metar_cache.failed_message(station, [(start, end)]))
+        yield from _timed_chunks(chunks)
+
+
+def iter_metar_files(files, chunksize=METAR_CHUNKSIZE):
+    # the chunks of IEM files already on disk, e.g. the months batch_run
+    # downloads in its parent process
+    for fn in files:
+        with open(fn, encoding='utf-8') as f:
+            yield from _timed_chunks(read_metar_chunks(f, chunksize))
 
-    return data
+
+class _CountingReader(io.RawIOBase):
+    # a binary stream that counts the bytes read through it
+    def __init__(self, raw):
+        self.raw = raw
+        self.nbytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.raw.readinto(b)
+        self.nbytes += n or 0
+        return n
+
+
+def _timed_chunks(chunks):
+    chunks = iter(chunks)
+    while True:
+        with timing.stage('read_csv') as info:
+            chunk = next(chunks, None)
+            info['rows'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        yield chunk
 
 
 def make_metar_dataframe(df):
-    df2 = pd.DataFrame()
-    df2['date'] = df.valid
-    df2['date'] = pd.to_datetime(df2.date)
-    df2['lat'] = df.lat
-    df2['lon'] = df.lon
-    df2['atmospheric_pressure_inHg'] = df.alti
-    df2['atmospheric_pressure_mb'] = df.alti * 33.8639
-    df2['air_temperature_F'] = df.tmpf
-    df2['air_temperature_C'] = (df.tmpf - 32) * 5 / 9
-    df2['dewpoint_F'] = df.dwpf
-    df2['dewpoint_C'] = (df.dwpf - 32) * 5 / 9
-    df2['humidity_%RH'] = df.relh
-    df2['wind_speed_ms'] = df.sknt * 0.51  # 0.51 m/s per knot
-    df2['wind_direction_deg_from_N'] = df.drct
-    df2 = df2.set_index(df2.date)
-    df2 = df2.drop(['date'], axis=1)
-
-    # get cloudiness
-    cloud_dict = {'CLR': 0, 'SKC': 0, 'FEW': 1.5 / 8, 'SCT': 3.5 / 8, 'BKN': 6 / 8, 'OVC': 8 / 8}
-    df = df.set_index(pd.to_datetime(df.valid))
-    df2['cloudiness'] = pd.concat(
-        [df.skyc1.map(cloud_dict),
-         df.skyc2.map(cloud_dict),
-         df.skyc3.map(cloud_dict),
-         df.skyc4.map(cloud_dict)], axis=1).max(axis=1)
-
-    tz = 'Etc/UTC'
-    df2 = df2.tz_localize(tz=tz)
+    # df is either the raw IEM DataFrame or an iterable of raw chunks
+    if not isinstance(df, pd.DataFrame):
+        frames = [make_metar_dataframe(chunk) for chunk in df]
+        if not frames:
+            # an empty or header-only download has no chunks, decode no rows
+            # so the result still has the decoded columns and dtypes
+            return decode_metar(pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in METAR_DTYPES.items()}))
+        return pd.concat(frames)
+    return decode_metar(df)
+
+
+@timing.timed('decode', count='input')
+def decode_metar(df):
+    # decode one raw IEM DataFrame into the heat flux inputs, in UTC
+    # timestamps are parsed once and become the index
+    index = pd.DatetimeIndex(pd.to_datetime(df['valid']), name='date').tz_localize('Etc/UTC')
+
+    def col(name):
+        return df[name].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    tmpf = col('tmpf')
+    dwpf = col('dwpf')
+    alti = col('alti')
+
+    # get cloudiness, each sky cover layer is turned into category codes and
+    # looked up into one 2-D array, unknown or missing codes (-1) map to -1 and
+    # only become NaN when no layer was reported
+    layers = np.empty((len(df), len(SKY_COLUMNS)), dtype=np.float32)
+    for j, name in enumerate(SKY_COLUMNS):
+        sky = df[name].astype('category')
+        lookup = np.array([CLOUD_COVER.get(code, -1) for code in sky.cat.categories] + [-1], dtype=np.float32)
+        layers[:, j] = lookup[sky.cat.codes.to_numpy()]
+    cloudiness = layers.max(axis=1, initial=-1)
+    cloudiness[cloudiness < 0] = np.nan
+
+    # coordinates stay float64, everything else is float32
+    df2 = pd.DataFrame({
+        'lat': df['lat'].to_numpy(dtype=np.float64, na_value=np.nan),
+        'lon': df['lon'].to_numpy(dtype=np.float64, na_value=np.nan),
+        'atmospheric_pressure_inHg': alti,
+        'atmospheric_pressure_mb': alti * np.float32(33.8639),
+        'air_temperature_F': tmpf,
+        'air_temperature_C': (tmpf - 32) * np.float32(5 / 9),
+        'dewpoint_F': dwpf,
+        'dewpoint_C': (dwpf - 32) * np.float32(5 / 9),
+        'humidity_%RH': col('relh'),
+        'wind_speed_ms': col('sknt') * np.float32(0.51),  # 0.51 m/s per knot
+        'wind_direction_deg_from_N': col('drct'),
+        'cloudiness': cloudiness,
+    }, index=index)
     return df2
 
+def get_timezone_finder():
+    # loading the timezone polygons is slow, so one finder is shared by the module
+    global _timezone_finder
+    if _timezone_finder is None:
+        _timezone_finder = TimezoneFinder()
+    return _timezone_finder
+
+
+def get_timezone(lat, lon):
+    # memoized in TIMEZONE_CACHE, keyed on the coordinates rounded to ~10 m
+    global _timezones
+    key = '%.4f,%.4f' % (lat, lon)
+    with _timezones_lock:
+        if _timezones is None:
+            _timezones = metar_cache.load_table(TIMEZONE_CACHE)
+        if key in _timezones:
+            return _timezones[key]
+
+        tf = get_timezone_finder()
+        timezone_str = tf.timezone_at(lat=lat, lng=lon)
+        if timezone_str is None:
+            # Fallback if timezone_at fails
+            timezone_str = tf.certain_timezone_at(lat=lat, lng=lon)
+        if timezone_str is None:
+            # If still None, default to UTC
+            timezone_str = 'Etc/UTC'
+
+        _timezones[key] = timezone_str
+        metar_cache.save_table(TIMEZONE_CACHE, _timezones)
+        return timezone_str
+
+
 def make_metar_dataframe_local(df):
-    # Initialize the TimezoneFinder
-    tf = TimezoneFinder()
-    
-    # Create a new DataFrame with required columns
-    df2 = pd.DataFrame()
-    df2['date'] = df.valid
-    df2['date'] = pd.to_datetime(df2.date)
-    df2['lat'] = df.lat
-    df2['lon'] = df.lon
-    df2['atmospheric_pressure_inHg'] = df.alti
-    df2['atmospheric_pressure_mb'] = df.alti * 33.8639
-    df2['air_temperature_F'] = df.tmpf
-    df2['air_temperature_C'] = (df.tmpf - 32) * 5 / 9
-    df2['dewpoint_F'] = df.dwpf
-    df2['dewpoint_C'] = (df.dwpf - 32) * 5 / 9
-    df2['humidity_%RH'] = df.relh
-    df2['wind_speed_ms'] = df.sknt * 0.51  # 0.51 m/s per knot
-    df2['wind_direction_deg_from_N'] = df.drct
-    df2 = df2.set_index(df2.date)
-    df2 = df2.drop(['date'], axis=1)
-
-    # get cloudiness
-    cloud_dict = {'CLR': 0, 'SKC': 0, 'FEW': 1.5 / 8, 'SCT': 3.5 / 8, 'BKN': 6 / 8, 'OVC': 8 / 8}
-    df = df.set_index(pd.to_datetime(df.valid))
-    df2['cloudiness'] = pd.concat(
-        [df.skyc1.map(cloud_dict),
-         df.skyc2.map(cloud_dict),
-         df.skyc3.map(cloud_dict),
-         df.skyc4.map(cloud_dict)], axis=1).max(axis=1)
-
-    tz = 'Etc/UTC'
-    df2 = df2.tz_localize(tz=tz)
-    
-    # Function to convert UTC to local time based on lat/lon
-    timezone_str = tf.timezone_at(lat=df.lat[0],lng=df.lon[0])
-    if timezone_str is None:
-        # Fallback if timezone_at fails
-        timezone_str = tf.certain_timezone_at(lat=df.lat[0],lng=df.lon[0])
-    if timezone_str is None:
-        # If still None, default to UTC
-        timezone_str = 'Etc/UTC'
-        #    local_tz = pytz.timezone(timezone_str)
-        #     return row['date_utc'].astimezone(local_tz)
-        # except Exception as e:
-        #     # In case of any error, return UTC time
-        #     return row['date_utc']
-    print(timezone_str)
+    # decode in UTC, then convert to the station's local time
+    df2 = make_metar_dataframe(df)
+    if df2.empty:
+        # no coordinates to find the timezone from
+        return df2
+
+    lat, lon = return_lat_lon(df2)
+    timezone_str = get_timezone(lat, lon)
     df2 = df2.tz_convert(tz=timezone_str)
     return df2
 
-def get_elevation(lat, lon):
-    url = f'https://api.opentopodata.org/v1/ned10m?locations={lat},{lon}'
-    result = requests.get(url)
-    return result.json()['results'][0]['elevation']
-
-
 def get_solar(lat, lon, elevation, site_name, times, tz):
     site = Location(lat, lon, tz, elevation, site_name)
     cs = site.get_clearsky(times)
@@ -178,18 +339,75 @@ def calc_sensible_heat(T_air, f_U, T_water):
 def calc_vapor_pressure(T_dewpoint):
     return 6.11 * 10 ** (7.5 * T_dewpoint / (237.3 + T_dewpoint))
 
-def plot_met(df):
-    # Prepare the data for plotting
-    df = df[~df.index.duplicated(keep='first')]
-    df_met = df[['air_temperature_C', 'humidity_%RH', 'dewpoint_C', 
-                'atmospheric_pressure_mb', 'cloudiness', 'wind_speed_ms']]
-    
-    df_met = pd.melt(df_met.reset_index(), id_vars=df_met.index.name or 'date', 
-                     var_name='variable', value_name='value')
-    df_met = df_met.rename(columns={'index': 'date'})
-    
-    # Create a Plotly figure
-    variables = df_met['variable'].unique()
+def downsample_minmax(x, y, n_buckets):
+    # keep the minimum and maximum of y in each of n_buckets equal time buckets,
+    # in time order, so peaks survive while the point count drops to 2 * n_buckets
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=np.float64)
+    keep = ~np.isnan(y)
+    x, y = x[keep], y[keep]
+    if len(y) <= 2 * n_buckets:
+        return x, y
+    t = x.view('int64') if x.dtype.kind == 'M' else x.astype('int64')
+    if np.any(np.diff(t) < 0):
+        order = np.argsort(t, kind='stable')
+        x, y, t = x[order], y[order], t[order]
+
+    # buckets are contiguous runs of the sorted times
+    edges = np.linspace(t[0], t[-1], n_buckets + 1)
+    starts = np.unique(np.searchsorted(t, edges[:-1], side='left'))
+    starts = starts[starts < len(t)]
+    lengths = np.diff(np.r_[starts, len(t)])
+    bucket = np.repeat(np.arange(len(starts)), lengths)
+
+    picks = []
+    for extreme in (np.minimum, np.maximum):
+        hits = np.flatnonzero(y == np.repeat(extreme.reduceat(y, starts), lengths))
+        # first hit in each bucket
+        picks.append(hits[np.unique(bucket[hits], return_index=True)[1]])
+    picks = np.unique(np.concatenate(picks))
+    return x[picks], y[picks]
+
+
+def plot_times(times):
+    # plotly shows tz-aware times in their own wall clock, do the same with plain datetime64
+    times = pd.DatetimeIndex(times)
+    if times.tz is not None:
+        times = times.tz_localize(None)
+    return times.to_numpy()
+
+
+def plot_points(index, width_px=PLOT_WIDTH_PX, downsample=True):
+    # number of time buckets to aggregate a record into, None if it is short
+    # enough to plot as is; the time span is cut into buckets of the finest
+    # PLOT_RESOLUTIONS step that gives at most width_px of them
+    if not downsample or len(index) <= 2 * width_px:
+        return None
+    span = index.max() - index.min()
+    for step in PLOT_RESOLUTIONS:
+        n_buckets = int(np.ceil(span / pd.Timedelta(step)))
+        if n_buckets <= width_px:
+            break
+    return max(n_buckets, 1)
+
+
+def line_trace(x, y, n_buckets=None, **kwargs):
+    # Scatter trace of one series, downsampled when n_buckets is given and
+    # switched to WebGL when it would still be large
+    if n_buckets:
+        x, y = downsample_minmax(x, y, n_buckets)
+    trace = go.Scattergl if len(y) > WEBGL_POINTS else go.Scatter
+    return trace(x=x, y=y, mode='lines', **kwargs)
+
+
+@timing.timed('plot_met', count='input')
+def plot_met(df, width_px=PLOT_WIDTH_PX, downsample=True):
+    # Prepare the data for plotting, traces come straight from the wide columns
+    duplicated = df.index.duplicated(keep='first')
+    if duplicated.any():
+        df = df[~duplicated]
+    variables = ['air_temperature_C', 'humidity_%RH', 'dewpoint_C',
+                 'atmospheric_pressure_mb', 'cloudiness', 'wind_speed_ms']
     colors = {
         'air_temperature_C': 'red',
         'humidity_%RH': 'blue',
@@ -199,6 +417,7 @@ def plot_met(df):
         'wind_speed_ms': 'brown'
     }
     
+    # Create a Plotly figure
     fig = make_subplots(
         rows=len(variables),
         cols=1,
@@ -207,13 +426,14 @@ def plot_met(df):
         subplot_titles=variables
     )
     
+    x = plot_times(df.index)
+    n_buckets = plot_points(df.index, width_px, downsample)
     for i, var in enumerate(variables, start=1):
-        subset = df_met[df_met['variable'] == var]
         fig.add_trace(
-            go.Scatter(
-                x=subset['date'], 
-                y=subset['value'], 
-                mode='lines', 
+            line_trace(
+                x,
+                df[var].to_numpy(),
+                n_buckets,
                 name=var, 
                 line=dict(color=colors.get(var, 'black')),
                 connectgaps=True
@@ -222,14 +442,6 @@ def plot_met(df):
             col=1
         )
         
-        fig.add_shape(
-            type='rect',
-            xref='x domain', x0=0, x1=1,
-            yref='y domain', y0=0, y1=1,
-            line=dict(color='black', width=2),
-            row=i, col=1
-        )
-        
         if var == "air_temperature_C":
             fig.add_hline(
                 y=0,
@@ -247,113 +459,240 @@ def plot_met(df):
         font=dict(color='black'),
         title_font=dict(color='black', size=16)
     )
-    
+
+    # one update styles every subplot, the mirrored axis lines draw the box around each
+    axis_style = dict(showgrid=True, gridwidth=1, gridcolor='lightgray', tickfont=dict(color='black'),
+                      title_font=dict(color='black'), showline=True, mirror=True, linecolor='black',
+                      linewidth=2)
+    fig.update_xaxes(**axis_style)
+    fig.update_yaxes(**axis_style)
     fig.update_xaxes(title_text="Date", row=len(variables), col=1)
     
-    for i in range(1, len(variables) + 1):
-        fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='lightgray', row=i, col=1)
-        fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='lightgray', row=i, col=1)
-        fig.update_xaxes(tickfont=dict(color='black'), title_font=dict(color='black'), row=i, col=1)
-        fig.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'), row=i, col=1)
-    
     return fig
 
-def calc_fluxes(df, T_water_C, lat, lon, a=10 ** -6, b=10 ** -6, c=1, R=1):
+def read_water_temperature_csv(f, tz='UTC'):
+    # gauge record with timestamps in the first column and water temperature (C)
+    # in the second, naive timestamps are taken to be in tz
+    wt = pd.read_csv(f, index_col=0, usecols=[0, 1])
+    wt.index = pd.DatetimeIndex(pd.to_datetime(wt.index), name='date')
+    if wt.index.tz is None:
+        wt = wt.tz_localize(tz)
+    return wt.iloc[:, 0].astype(np.float32).rename('water_temperature_C')
+
+
+def align_water_temperature(T_water_C, index, max_gap=WATER_MAX_GAP):
+    # water temperature at the METAR times, interpolated linearly between the
+    # gauge readings either side; times outside the gauge record or between
+    # readings more than max_gap apart get NaN, and drop out of the fluxes
+    wt = T_water_C.dropna().sort_index()
+    wt = wt[~wt.index.duplicated(keep='first')]
+    t = index_ns(wt.index)
+    x = index_ns(index)
+    values = np.full(len(index), np.nan)
+    if len(t):
+        right = np.searchsorted(t, x, side='left')
+        r, l = np.minimum(right, len(t) - 1), np.maximum(right - 1, 0)
+        ok = (t[r] == x) | ((right > 0) & (right < len(t)) & (t[r] - t[l] <= pd.Timedelta(max_gap).value))
+        values[ok] = np.interp(x[ok], t, wt.to_numpy(dtype=np.float64))
+    missing = int(np.isnan(values).sum())
+    if missing:
+        warnings.warn('no water temperature for %d of %d times (outside the gauge record or in gaps over %s), '
+                      'their fluxes are dropped' % (missing, len(index), pd.Timedelta(max_gap)))
+    return pd.Series(values, index=index, name='water_temperature_C')
+
+
+def calc_fluxes(df, T_water_C, lat, lon, a=10 ** -6, b=10 ** -6, c=1, R=1, elevation=None,
+                water_max_gap=WATER_MAX_GAP):
+    # T_water_C is a constant or a time series (e.g. from read_water_temperature_csv),
+    # a series is interpolated to the METAR times first, across gaps of up to water_max_gap
+    if isinstance(T_water_C, pd.Series):
+        T_water_C = align_water_temperature(T_water_C, df.index, water_max_gap)
+
     # calc solar input
     # times = pd.date_range(start=df.index.min(), end=df.index.max(), freq='1H')
     times = df.index
-    elevation = get_elevation(lat, lon)
+    # pass elevation (m) to run without any elevation lookup
+    if elevation is None:
+        elevation = get_elevation(lat, lon)
 
-    site_name = 'general location'
-    tz = df.index.tz
-    ghi = get_solar(lat, lon, elevation, site_name, times, tz).ghi
+    # clear-sky GHI comes from the precomputed per-site grid, see clearsky.py
+    ghi = get_clearsky_ghi(lat, lon, elevation, times)
 
-    # calculate effects of clouds on shortwave
-    solar_R = 0.15  # Maidment et al. (1996) Handbook of Hydrology
-    Cl = df['cloudiness']
-    q_sw = calc_solar(ghi, solar_R, Cl)
+    # the flux arithmetic, after the elevation and solar lookups
+    with timing.stage('flux_math', rows=len(df)):
+        # calculate effects of clouds on shortwave
+        solar_R = 0.15  # Maidment et al. (1996) Handbook of Hydrology
+        Cl = df['cloudiness']
+        q_sw = calc_solar(ghi, solar_R, Cl)
 
-    # calc longwave down
-    T_air_C = df['air_temperature_C']
-    q_atm = calc_downwelling_LW(T_air_C, Cl)
+        # calc longwave down
+        T_air_C = df['air_temperature_C']
+        q_atm = calc_downwelling_LW(T_air_C, Cl)
 
-    # calc longwave up
-    q_b = calc_upwelling_LW(T_water_C)
+        # calc longwave up
+        q_b = calc_upwelling_LW(T_water_C)
 
-    # calc wind function
-    # a = 10 ** -6
-    # b = 10 ** -6
-    # c = 1
-    # R = 1
+        # calc wind function
+        # a = 10 ** -6
+        # b = 10 ** -6
+        # c = 1
+        # R = 1
 
-    U = df['wind_speed_ms']
-    f_U = calc_wind_function(a, b, c, R, U)
+        U = df['wind_speed_ms']
+        f_U = calc_wind_function(a, b, c, R, U)
 
-    # calc latent heat
-    relative_humidity = df['humidity_%RH']
-    T_dewpoint_C = df['dewpoint_C']
-    ea = calc_vapor_pressure(T_dewpoint_C)
-    P = df['atmospheric_pressure_mb']
+        # calc latent heat
+        relative_humidity = df['humidity_%RH']
+        T_dewpoint_C = df['dewpoint_C']
+        ea = calc_vapor_pressure(T_dewpoint_C)
+        P = df['atmospheric_pressure_mb']
 
-    q_l = calc_latent_heat(P, T_water_C, ea, f_U)
+        q_l = calc_latent_heat(P, T_water_C, ea, f_U)
 
-    # calc sensible heat
-    q_h = calc_sensible_heat(T_air_C, f_U, T_water_C)
+        # calc sensible heat
+        q_h = calc_sensible_heat(T_air_C, f_U, T_water_C)
 
-    # calculate net heat flux
-    q_net = q_sw + q_atm - q_b + q_h - q_l
+        # calculate net heat flux
+        q_net = q_sw + q_atm - q_b + q_h - q_l
 
     return q_sw, q_atm, q_b, q_l, q_h, q_net
 
+def calc_fluxes_sweep(df, T_water_C, lat, lon, a=10 ** -6, b=10 ** -6, c=1, R=1, elevation=None):
+    """
+    Fluxes for many scenarios at once. T_water_C, a, b, c and R may each be a
+    scalar or a 1-D array; they are broadcast against each other into S
+    scenarios (use np.meshgrid first for a full grid). The met-derived terms
+    and the elevation and solar lookups are done once for all scenarios.
+
+    Returns q_sw, q_atm, q_b, q_l, q_h, q_net like calc_fluxes, each as a
+    (time x scenario) NumPy array. The terms that don't depend on the
+    scenario are read-only broadcast views, so they cost no extra memory.
+    """
+    T_water_C, a, b, c, R = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype=np.float64))
+                                                  for v in (T_water_C, a, b, c, R)))
+    n_times, n_scenarios = len(df), T_water_C.shape[0]
+
+    if elevation is None:
+        elevation = get_elevation(lat, lon)
+    ghi = get_clearsky_ghi(lat, lon, elevation, df.index).to_numpy()
+
+    with timing.stage('flux_math', rows=len(df)):
+        # met-derived terms, one column each
+        solar_R = 0.15  # Maidment et al. (1996) Handbook of Hydrology
+        Cl = df['cloudiness'].to_numpy()
+        T_air_C = df['air_temperature_C'].to_numpy()[:, None]
+        U = df['wind_speed_ms'].to_numpy()[:, None]
+        ea = calc_vapor_pressure(df['dewpoint_C'].to_numpy())[:, None]
+        P = df['atmospheric_pressure_mb'].to_numpy()[:, None]
+        q_sw = calc_solar(ghi, solar_R, Cl)[:, None]
+        q_atm = calc_downwelling_LW(df['air_temperature_C'].to_numpy(), Cl)[:, None]
+
+        # scenario terms, one row each
+        q_b = calc_upwelling_LW(T_water_C)[None, :]
+        f_U = calc_wind_function(a[None, :], b[None, :], c[None, :], R[None, :], U)
+        q_l = calc_latent_heat(P, T_water_C[None, :], ea, f_U)
+        q_h = calc_sensible_heat(T_air_C, f_U, T_water_C[None, :])
+
+        q_net = q_sw + q_atm - q_b + q_h - q_l
+
+    shape = (n_times, n_scenarios)
+    return (np.broadcast_to(q_sw, shape), np.broadcast_to(q_atm, shape), np.broadcast_to(q_b, shape),
+            q_l, q_h, q_net)
+
+def calc_energy_df(df, T_water_C, lat, lon, a=10 ** -6, b=10 ** -6, c=1, R=1, elevation=None, dtype=np.float32,
+                   water_max_gap=WATER_MAX_GAP):
+    """
+    calc_fluxes and build_energy_df in one pass, for long records and batches.
+
+    Each flux is written straight into its column of one preallocated
+    (time x 6) block of dtype, with the loss terms negated in place, and the
+    rows with missing data are dropped once. Returns the same columns as
+    build_energy_df without the intermediate Series and copies, and in
+    float32 at half the memory unless another dtype is given.
+    """
+    if isinstance(T_water_C, pd.Series):
+        T_water_C = align_water_temperature(T_water_C, df.index, water_max_gap)
+    if elevation is None:
+        elevation = get_elevation(lat, lon)
+    ghi = get_clearsky_ghi(lat, lon, elevation, df.index).to_numpy()
+
+    with timing.stage('flux_math', rows=len(df)):
+        # the water temperature terms stay float64, the saturation vapor
+        # pressure polynomial loses too much to cancellation in float32
+        T_water_C = np.asarray(T_water_C, dtype=np.float64)
+        solar_R = 0.15  # Maidment et al. (1996) Handbook of Hydrology
+        Cl = df['cloudiness'].to_numpy()
+        T_air_C = df['air_temperature_C'].to_numpy()
+        f_U = calc_wind_function(a, b, c, R, df['wind_speed_ms'].to_numpy())
+        ea = calc_vapor_pressure(df['dewpoint_C'].to_numpy())
+        P = df['atmospheric_pressure_mb'].to_numpy()
+
+        block = np.empty((len(df), len(ENERGY_COLUMNS)), dtype=dtype)
+        block[:, 0] = calc_solar(ghi, solar_R, Cl)
+        block[:, 1] = calc_downwelling_LW(T_air_C, Cl)
+        block[:, 2] = calc_upwelling_LW(T_water_C)
+        block[:, 3] = calc_sensible_heat(T_air_C, f_U, T_water_C)
+        block[:, 4] = calc_latent_heat(P, T_water_C, ea, f_U)
+        np.negative(block[:, 2], out=block[:, 2])
+        np.negative(block[:, 4], out=block[:, 4])
+        np.sum(block[:, :5], axis=1, out=block[:, 5])
+
+        # a missing term makes the net flux NaN, so one mask drops them all
+        keep = ~np.isnan(block[:, 5])
+        index = df.index
+        if not keep.all():
+            block, index = block[keep], index[keep]
+    return pd.DataFrame(block, index=index, columns=ENERGY_COLUMNS, copy=False)
+
 def return_lat_lon(df):
-    lat = df.lat[0]
-    lon = df.lon[0]
+    lat = df.lat.iloc[0]
+    lon = df.lon.iloc[0]
     return lat, lon
 
+@timing.timed('build_energy_df')
 def build_energy_df(q_sw, q_atm, q_b, q_l, q_h):
-    energy_df = pd.DataFrame(
-        {'downwelling SW': q_sw, 'downwelling LW': q_atm, 'upwelling LW': -q_b, 'sensible heat': q_h,
-         'latent heat': -q_l})
+    energy_df = pd.DataFrame(dict(zip(ENERGY_COLUMNS, (q_sw, q_atm, -q_b, q_h, -q_l))))
     energy_df['net flux'] = energy_df.sum(axis=1)
     #remove rows with missing data
     energy_df = energy_df.dropna()
     return energy_df
 
-def plot_historic_heat_fluxes(energy_df):
+@timing.timed('plot_fluxes', count='input')
+def plot_historic_heat_fluxes(energy_df, width_px=PLOT_WIDTH_PX, downsample=True):
     """
     Create an interactive Plotly line plot of heat fluxes, highlighting 'net flux'
     in bold black.
+
+    Long records are reduced to the min and max of each time bucket before the
+    traces are built, with the bucket size picked from the time span so there
+    are at most width_px buckets (hourly for two months, 3-daily for ten
+    years), so multi-year plots stay small and fast. Pass downsample=False to
+    plot every point.
     """
-    # Convert wide DataFrame to long-form
-    energy_long = pd.melt(energy_df.reset_index(), id_vars='date')
-
-    # Create the Plotly Express line chart
-    fig = px.line(
-        energy_long,
-        x='date',
-        y='value',
-        color='variable',
-        # color_discrete_sequence=px.colors.qualitative.Bold,
-        # If you want consistent coloring per variable, you could specify a dict:
-        color_discrete_map={
-            'downwelling SW': 'blue',
-            'downwelling LW': 'orange',
-            'upwelling LW': 'green',
-            'sensible heat': 'red',
-            'latent heat': 'purple',
-            'net flux': 'black'
-        },
-    )
+    colors = {
+        'downwelling SW': 'blue',
+        'downwelling LW': 'orange',
+        'upwelling LW': 'green',
+        'sensible heat': 'red',
+        'latent heat': 'purple',
+        'net flux': 'black'
+    }
 
-    # Make the 'net flux' line thicker and black
-    for trace in fig.data:
-        if trace.name == 'net flux':
-            trace.line.width = 3
-            trace.line.color = 'black'
+    # traces are built straight from the wide columns, one per flux
+    n_buckets = plot_points(energy_df.index, width_px, downsample)
+    x = plot_times(energy_df.index)
+    fig = go.Figure()
+    for name in energy_df.columns:
+        if name == 'net flux':
+            # Make the 'net flux' line thicker and black
+            line = dict(color='black', width=3)
+            opacity = 1
         else:
             # Optionally make other lines thinner or semi-transparent
-            trace.line.width = 2
-            trace.opacity = 0.8
+            line = dict(color=colors.get(name), width=2)
+            opacity = 0.8
+        fig.add_trace(line_trace(x, energy_df[name].to_numpy(), n_buckets, name=name, line=line,
+                                 opacity=opacity))
 
     # Customize layout
     fig.update_layout(